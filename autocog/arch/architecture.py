@@ -10,6 +10,8 @@ from .orchestrator import Orchestrator, Serial
 
 from ..lm.lm import LM
 
+from ..fta.automaton import SearchOptions, Router
+
 from ..sta.syntax  import Syntax
 from ..sta.compile import compile
 
@@ -18,9 +20,13 @@ class CognitiveArchitecture(BaseModel):
     lm: LM
     syntax: Syntax
     libdir: List[str]
+    search: SearchOptions
+    router: Optional[Router] = None # routes some actions to other LMs than `lm`
 
-    def __init__(self, lm: LM, syntax: Syntax, libdir: List[str]=[], Orch=Serial, **kwargs):
-        super().__init__(orchestrator=Orch(**kwargs), lm=lm, syntax=syntax, libdir=libdir)
+    def __init__(self, lm: LM, syntax: Syntax, libdir: List[str]=[], Orch=Serial, search: Optional[SearchOptions]=None, router: Optional[Router]=None, **kwargs):
+        if search is None:
+            search = SearchOptions()
+        super().__init__(orchestrator=Orch(**kwargs), lm=lm, syntax=syntax, libdir=libdir, search=search, router=router)
 
         installed_libpath = os.path.realpath(os.path.dirname(__file__) + '/../library')
         repository_libpath = os.path.realpath(os.path.dirname(__file__) + '/../../share/library')
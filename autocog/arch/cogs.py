@@ -1,6 +1,7 @@
 from typing import Any, Dict, List, Tuple, Union, Optional, Callable, NamedTuple
 from pydantic import BaseModel
 from abc import abstractmethod
+import hashlib
 
 from ..sta.ir import Program, Return, Control
 from ..sta.automaton import Automaton as STA
@@ -79,10 +80,11 @@ class Automaton(Cog):
                 __page.ftts.update({ ptag : [] })
 
             frame = await sta.assemble(self.arch, __page, inputs)
+            await self.prefill(sta, ptag)
             fta = sta.instantiate(syntax=self.arch.syntax, frame=frame, branches=__page.branches[ptag], inputs=inputs)
             __page.ftas[ptag].append(fta)
             fta.simplify()
-            ftt = fta.greedy(lm=self.arch.lm)
+            ftt = await fta.agreedy(lm=self.arch.lm, options=self.arch.search, router=self.arch.router, cog=self.tag, prompt=ptag)
             __page.ftts[ptag].append(ftt)
             next = sta.parse(lm=self.arch.lm, syntax=self.arch.syntax, stacks=__page.stacks, ftt=ftt)
             if isinstance(next, Return):
@@ -101,6 +103,13 @@ class Automaton(Cog):
 
         raise Exception("Should be unreachable!!!")
 
+    async def prefill(self, sta:STA, ptag:str):
+        """Let the LM precompute (or load) its state after the header of the prompt"""
+        syntax = hashlib.sha256(self.arch.syntax.model_dump_json().encode()).hexdigest()
+        key = f"{syntax}/{self.tag}/{ptag}"
+        if self.arch.lm.needs_prefill(key):
+            await self.arch.lm.aprefill(self.arch.lm.tokenize(self.arch.syntax.header(sta.prompt)), key)
+
     def toGraphViz(self):
         dotstr = ''
         for (tag,prompt) in self.prompts:
@@ -54,4 +54,4 @@ class Async(Orchestrator):
         else:
             gather = asyncio.gather
 
-        return await gather(*super().coroutines(jobs, parent))
+        return await gather(*super().coropage(jobs, parent))
@@ -84,19 +84,20 @@ class Choose(Action):
 
 class Complete(Action):
     length: int = 1
-    beams:  int = 1
-    ahead:  int = 1
+    beams:  Optional[int] = None # defaults to the search options
+    ahead:  Optional[int] = None
     stop:   str = ''
+    width:  Optional[int] = 1    # number of beams continued by the successors (each one expands the rest of the automaton)
 
     seeds:  Optional[List[str]]
     vocab:  Vocab
 
-    def __init__(self, uid:str, length:int, stop: str='', seeds: Optional[List[str]] = None, successors: List[str]=[]):
-        super().__init__(uid=uid, successors=successors, length=length, stop=stop, seeds=seeds, vocab=Vocab())
+    def __init__(self, uid:str, length:int, stop: str='', seeds: Optional[List[str]] = None, successors: List[str]=[], width:Optional[int]=1):
+        super().__init__(uid=uid, successors=successors, length=length, stop=stop, seeds=seeds, vocab=Vocab(), width=width)
 
     def prepare(self, lm):
         if self.seeds is not None:
-            vocab.prepare(lm, self.seeds + [self.stop])
+            self.vocab.prepare(lm, self.seeds + [self.stop])
 
     def step(self, lm, prompt:List[Token], step:int, min_branch:int, max_branch:int, tok_clip:float) -> Dict[Token,float]:
         raise NotImplementedError()
@@ -7,14 +7,63 @@ from .vocab import Token, Vocab
 from .actions import Action, Choose, Text, Complete
 from .ftt import FTT_Proba, FiniteTokenTree
 from .tct import TokenChoiceTree
-from .beam import beam_search
+from .beam import abeam_search
+from .utils import run_sync
 
 from ..lm.lm import LM
 
 import copy
 import json
+import asyncio
+import heapq
 import numpy
 
+class SearchOptions(BaseModel):
+    choose: str = 'token' # Choose actions are evaluated per `token` (one LM call per node of the TokenChoiceTree) or per `sequence` (one LM call per choice)
+    draft: Optional[LM] = None # small LM proposing the tokens of Complete actions (verified by the LM of the action)
+    speculate: int = 4         # number of tokens proposed by `draft` for each verification
+    beams: int = 1             # number of hypotheses kept by the beam search of Complete actions (only the `width` best are continued, each one expands the rest of the automaton)
+    ahead: int = 1             # number of tokens used to rank the extensions of the hypotheses (1 is the standard beam search)
+    prune: bool = False        # Choose actions with a `width` (and no `threshold`) stop expanding the choices that cannot be among the `width` best (only with choose='token')
+    normalized: bool = True    # scoring selecting the `width` best successors of an action, bounding the pruning, and ordering the `best` driver (see FTT_Proba.scoring)
+    tokwise: bool = True
+    driver: str = 'depth'      # expansion of the automaton: `depth` (recursive, every selected branch is completed) or `best` (priority queue of the best scoring trees)
+    paths: Optional[int] = None      # the `best` driver stops after this number of complete paths
+    max_tokens: Optional[int] = None # the `best` driver stops after adding this number of tokens to the tree
+    max_calls: Optional[int] = None  # the `best` driver stops after this number of calls to the LMs (cache hits are not counted)
+
+class Route(BaseModel):
+    """Actions matching all the criteria (`None` matches everything) are evaluated with `lm`"""
+    lm: LM
+    kinds: Optional[List[str]] = None   # names of the action classes: Text, Choose, Complete
+    cogs: Optional[List[str]] = None    # tags of the cogs
+    prompts: Optional[List[str]] = None # names of the prompts
+
+    def match(self, action:Action, cog:Optional[str]=None, prompt:Optional[str]=None) -> bool:
+        if self.kinds is not None and not action.__class__.__name__ in self.kinds:
+            return False
+        if self.cogs is not None and not cog in self.cogs:
+            return False
+        if self.prompts is not None and not prompt in self.prompts:
+            return False
+        return True
+
+class Router(BaseModel):
+    """Selects the LM evaluating each action using the first matching route (all LMs must share the tokenizer of the default LM)"""
+    routes: List[Route] = []
+    escalate: Optional[LM] = None
+    threshold: float = 0. # Choose actions are evaluated again with `escalate` when the probability of the best choice (relative to the other choices) is below
+
+    def select(self, lm:LM, action:Action, cog:Optional[str]=None, prompt:Optional[str]=None) -> LM:
+        for route in self.routes:
+            if route.match(action, cog=cog, prompt=prompt):
+                return route.lm
+        return lm
+
+    def confident(self, tok_probas) -> bool:
+        probas = numpy.array([ numpy.prod([ p for (t,p) in tok_proba ]) for tok_proba in tok_probas ])
+        return probas.sum() > 0 and probas.max() / probas.sum() >= self.threshold
+
 class FiniteThoughtAutomaton(BaseModel):
     actions: Dict[str,Action] = {}
 
@@ -54,8 +103,19 @@ class FiniteThoughtAutomaton(BaseModel):
                 pred.successors.extend(curr.successors)
                 del self.actions[cuid]
 
-    def greedy_rec(self, ptree:FiniteTokenTree, lm:LM, tokens:List[Token], action:Action):
+    @staticmethod
+    async def eval_choices(tct:TokenChoiceTree, lm:LM, tokens:List[Token], options:SearchOptions, width:Optional[int]=None, bound:Optional[Callable[[float,int],float]]=None):
+        if options.choose == 'token':
+            return await tct.aeval(lm, tokens, width=width, bound=bound)
+        elif options.choose == 'sequence':
+            return await tct.aeval_sequences(lm, tokens)
+        else:
+            raise Exception(f"Unknown evaluation of Choose: {options.choose}")
+
+    async def aexpand(self, ptree:FiniteTokenTree, lm:LM, tokens:List[Token], action:Action, options:SearchOptions, router:Optional[Router]=None, scope:Dict[str,Optional[str]]={}):
+        """Append the trees produced by `action` to `ptree` and return the (tree, action, tokens) left to expand"""
         todos = []
+        elm = lm if router is None else router.select(lm, action, **scope)
         if isinstance(action, Text):
             tree = FiniteTokenTree(parent=ptree, tokens=action.tokens)
             ptree.append(tree)
@@ -81,7 +141,13 @@ class FiniteThoughtAutomaton(BaseModel):
                     actions.update({ text.strip() : succ })
             assert len(actions) == 0 or len(actions) == len(action.choices), f"action={action} actions={actions}"
 
-            tok_probas = tct.eval(lm, tokens)
+            (width, bound) = (None, None)
+            if options.prune and action.threshold is None:
+                width = action.width
+                bound = FTT_Proba.bound(ptree, normalized=options.normalized, tokwise=options.tokwise)
+            tok_probas = await self.eval_choices(tct, elm, tokens, options, width=width, bound=bound)
+            if router is not None and router.escalate is not None and elm is not router.escalate and not router.confident(tok_probas):
+                tok_probas = await self.eval_choices(tct, router.escalate, tokens, options, width=width, bound=bound)
             choices_as_texts = list(list(zip(*action.choices))[0])
 
             for tok_proba in tok_probas:
@@ -100,7 +166,7 @@ class FiniteThoughtAutomaton(BaseModel):
                     tree.finalize()
 
         elif isinstance(action, Complete):
-            for (new_tokens, probas) in beam_search(lm, tokens, vocab=action.vocab, stop=action.stop, length=action.length, beams=action.beams, ahead=action.ahead):
+            for (new_tokens, probas) in await abeam_search(elm, tokens, vocab=action.vocab, stop=action.stop, length=action.length, beams=action.beams or options.beams, ahead=action.ahead or options.ahead, draft=options.draft, speculate=options.speculate):
                 tree = FiniteTokenTree(parent=ptree, tokens=new_tokens, probas=probas)
                 ptree.append(tree)
 
@@ -116,7 +182,9 @@ class FiniteThoughtAutomaton(BaseModel):
 
         ptree.finalize()
         if len(todos) > 1:
-            todo_scoring = lambda x: x[0].probas.tokwise_proba_norm
+            scoring = FTT_Proba.scoring(normalized=options.normalized, tokwise=options.tokwise, proba=True)
+            # Scores are `None` when all the probabilities are zero
+            todo_scoring = lambda x: -numpy.inf if scoring(x[0].probas) is None else scoring(x[0].probas)
             selection_width = action.width
             if action.threshold is not None:
                 max_prob = max(map(todo_scoring, todos))
@@ -126,17 +194,57 @@ class FiniteThoughtAutomaton(BaseModel):
                 else:
                     selection_width = 1
             if selection_width is not None and len(todos) > selection_width:
-                todos = sorted(todos, key=todo_scoring)
+                todos = sorted(todos, key=todo_scoring, reverse=True)
                 todos = list(todos)[:selection_width]
+        return todos
+
+    async def agreedy_rec(self, ptree:FiniteTokenTree, lm:LM, tokens:List[Token], action:Action, options:SearchOptions, router:Optional[Router]=None, scope:Dict[str,Optional[str]]={}):
+        for (tree,act,toks) in await self.aexpand(ptree=ptree, lm=lm, tokens=tokens, action=action, options=options, router=router, scope=scope):
+            await self.agreedy_rec(ptree=tree, lm=lm, tokens=toks, action=act, options=options, router=router, scope=scope)
 
-        for (tree,act,toks) in todos:
-            self.greedy_rec(ptree=tree, lm=lm, tokens=toks, action=act)
+    async def abestfirst(self, ptree:FiniteTokenTree, lm:LM, tokens:List[Token], action:Action, options:SearchOptions, router:Optional[Router]=None, scope:Dict[str,Optional[str]]={}):
+        """
+        Expand the tree with the best score first (instead of depth-first) until `options.paths` paths are complete or a budget is spent.
+        The search always continues until a first path is complete. Trees that are not expanded are left out of the results (not finalized).
+        """
+        scoring = FTT_Proba.scoring(normalized=options.normalized, tokwise=options.tokwise)
+        lms = [ lm, options.draft ] + ([] if router is None else [ route.lm for route in router.routes ] + [ router.escalate ])
+        lms = list({ id(lm_) : lm_ for lm_ in lms if lm_ is not None }.values())
+        calls = sum([ lm_.requests for lm_ in lms ])
+        (count, complete, spent) = (0, 0, 0)
+        queue = [ (0., count, ptree, action, tokens) ]
+        while len(queue) > 0:
+            (score, c, tree, act, toks) = heapq.heappop(queue)
+            todos = await self.aexpand(ptree=tree, lm=lm, tokens=toks, action=act, options=options, router=router, scope=scope)
+            complete += len([ child for child in tree.children if child.finalized ])
+            spent += sum([ len(child.tokens) for child in tree.children ])
+            if complete > 0:
+                if options.paths is not None and complete >= options.paths:
+                    break
+                if options.max_tokens is not None and spent >= options.max_tokens:
+                    break
+                if options.max_calls is not None and sum([ lm_.requests for lm_ in lms ]) - calls >= options.max_calls:
+                    break
+            for (tree_, act_, toks_) in todos:
+                count += 1
+                heapq.heappush(queue, (-(scoring(tree_.probas) or 0.), count, tree_, act_, toks_))
 
-    def greedy(self, lm: LM):
+    def greedy(self, lm: LM, options:Optional[SearchOptions]=None, router:Optional[Router]=None, cog:Optional[str]=None, prompt:Optional[str]=None):
+        return run_sync(self.agreedy(lm, options=options, router=router, cog=cog, prompt=prompt))
+
+    async def agreedy(self, lm: LM, options:Optional[SearchOptions]=None, router:Optional[Router]=None, cog:Optional[str]=None, prompt:Optional[str]=None):
+        """Same as `greedy` but the LM is called without blocking the event loop"""
+        if options is None:
+            options = SearchOptions()
         for action in self.actions.values():
             action.prepare(lm)
         root = FiniteTokenTree.root()
-        self.greedy_rec(ptree=root, lm=lm, tokens=[], action=self.actions['root'])
+        if options.driver == 'depth':
+            await self.agreedy_rec(ptree=root, lm=lm, tokens=[], action=self.actions['root'], options=options, router=router, scope={ 'cog' : cog, 'prompt' : prompt })
+        elif options.driver == 'best':
+            await self.abestfirst(ptree=root, lm=lm, tokens=[], action=self.actions['root'], options=options, router=router, scope={ 'cog' : cog, 'prompt' : prompt })
+        else:
+            raise Exception(f"Unknown search driver: {options.driver}")
         assert root.finalized
         return root
 
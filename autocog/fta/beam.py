@@ -1,30 +1,119 @@
-
 from typing import Any, Dict, List, Tuple, Union, Optional, Callable, NamedTuple
 from pydantic import BaseModel
 
 from .vocab import Token, Vocab
+from .utils import run_sync
 
 from ..lm.lm import LM
 
 import numpy
+import asyncio
+
+def masked(logprobs:numpy.ndarray, vocab:Vocab) -> numpy.ndarray:
+    """Logprobs of the tokens outside of `vocab` set to -inf"""
+    return logprobs if vocab.bounds is None else logprobs + vocab.mask(logprobs.shape[-1])
+
+def argmax(logprobs, vocab:Vocab) -> Tuple[Token,float]:
+    """Most probable token (in `vocab`) given the logprobs of the whole vocabulary"""
+    idx = int(numpy.argmax(masked(logprobs, vocab)))
+    return (idx, logprobs[idx])
+
+async def draft_tokens(draft: LM, tokens: List[Token], vocab:Vocab, count:int) -> List[Token]:
+    proposal = []
+    for i in range(count):
+        proposal.append(argmax(await draft.agreedy(tokens+proposal), vocab)[0])
+    return proposal
 
-def beam_search(lm: LM, tokens: List[Token], vocab:Vocab, stop:Union[str,List[Token]], length: int, beams: int, ahead: int):
-    assert beams == 1
-    assert ahead == 1
-    assert vocab.bounds is None
+def beam_search(lm: LM, tokens: List[Token], vocab:Vocab, stop:Union[str,List[Token]], length: int, beams: int, ahead: int, draft:Optional[LM]=None, speculate:int=4):
+    return run_sync(abeam_search(lm, tokens, vocab, stop, length, beams, ahead, draft=draft, speculate=speculate))
 
+async def abeam_search(lm: LM, tokens: List[Token], vocab:Vocab, stop:Union[str,List[Token]], length: int, beams: int, ahead: int, draft:Optional[LM]=None, speculate:int=4):
+    """Completions (tokens and probabilities) of the `beams` most probable hypotheses (greedy search when `beams` and `ahead` are 1)"""
     if isinstance(stop,str):
         stop = lm.tokenize(stop)
-    
+
+    if beams == 1 and ahead == 1:
+        return await agreedy_search(lm, tokens, vocab, stop, length, draft=draft, speculate=speculate)
+
+    alive = [ ([], []) ] # new tokens and their logprobs
+    scores = numpy.zeros(1, dtype=numpy.single)
+    finished = []
+    while len(alive) > 0:
+        # Hypotheses are evaluated as one batch, backends reuse the KV cache of their shared prefix
+        logprobs = await lm.agreedy_batch([ tokens + hyp for (hyp, lps) in alive ])
+        totals = scores[:,None] + masked(logprobs, vocab)
+
+        if ahead == 1:
+            selected = topk_indices(totals, beams)
+        else:
+            # Each of the best extensions is ranked with the probability of its next `ahead-1` greedy tokens
+            pool = topk_indices(totals, beams * beams)
+            (b, j) = numpy.unravel_index(pool, totals.shape)
+            prompts = [ tokens + alive[b_][0] + [ int(j_) ] for (b_, j_) in zip(b, j) ]
+            gains = await rollout(lm, prompts, vocab, min(ahead - 1, length - len(alive[0][0]) - 1))
+            selected = pool[numpy.argsort(-(totals.flat[pool] + gains), kind='stable')[:beams]]
+
+        (b, j) = numpy.unravel_index(selected, totals.shape)
+        (next_alive, next_scores) = ([], [])
+        for (b_, j_) in zip(b.tolist(), j.tolist()):
+            (hyp, lps) = alive[b_]
+            (hyp, lps) = (hyp + [ j_ ], lps + [ float(logprobs[b_, j_]) ])
+            if len(stop) > 0 and hyp[-len(stop):] == stop:
+                finished.append((float(totals[b_, j_]), hyp[:-len(stop)], lps[:-len(stop)]))
+            elif len(hyp) >= length:
+                finished.append((float(totals[b_, j_]), hyp, lps))
+            else:
+                next_alive.append((hyp, lps))
+                next_scores.append(totals[b_, j_])
+        (alive, scores) = (next_alive, numpy.asarray(next_scores, dtype=numpy.single))
+
+        # Scores only decrease so no alive hypothesis can beat `beams` better finished ones
+        finished = sorted(finished, key=lambda f: -f[0])[:beams]
+        if len(finished) == beams and (len(alive) == 0 or finished[-1][0] >= scores.max()):
+            break
+
+    return [ ( hyp, numpy.exp(lps).tolist() ) for (score, hyp, lps) in finished ]
+
+def topk_indices(scores:numpy.ndarray, k:int) -> numpy.ndarray:
+    """Flat indices of the `k` largest scores in decreasing order (non-finite scores, i.e. tokens masked out of the vocabulary, are never returned)"""
+    k = min(k, scores.size)
+    indices = numpy.argpartition(-scores, k-1, axis=None)[:k]
+    indices = indices[numpy.isfinite(scores.flat[indices])]
+    return indices[numpy.argsort(-scores.flat[indices], kind='stable')]
+
+async def rollout(lm: LM, prompts: List[List[Token]], vocab:Vocab, count:int) -> numpy.ndarray:
+    """Sum of the logprobs of the `count` greedy tokens (in `vocab`) following each prompt"""
+    gains = numpy.zeros(len(prompts), dtype=numpy.single)
+    for i in range(count):
+        logprobs = masked(await lm.agreedy_batch(prompts), vocab)
+        best = logprobs.argmax(axis=1)
+        gains += logprobs[numpy.arange(len(prompts)), best]
+        prompts = [ prompt + [ int(t) ] for (prompt, t) in zip(prompts, best) ]
+    return gains
+
+async def agreedy_search(lm: LM, tokens: List[Token], vocab:Vocab, stop:List[Token], length: int, draft:Optional[LM]=None, speculate:int=4):
     new_tokens = []
     probas = []
     while len(new_tokens) < length:
-        prob = numpy.exp(lm.greedy(tokens+new_tokens))
-
-        new_token = numpy.argmax(prob)
+        if draft is not None and draft is not lm:
+            # The draft model proposes a few tokens then the target model scores all of them in one evaluation.
+            # Proposed tokens are accepted while they are the target's greedy choice, the first disagreement is
+            # replaced by the target's choice, so the result (and its probabilities) is the same as without draft.
+            proposal = await draft_tokens(draft, tokens+new_tokens, vocab, min(speculate, length - len(new_tokens) - 1))
+            logprobs = await lm.agreedy_tail(tokens+new_tokens+proposal, len(proposal)+1)
+            accepted = []
+            for (i,row) in enumerate(logprobs):
+                accepted.append(argmax(row, vocab))
+                if i == len(proposal) or accepted[-1][0] != proposal[i]:
+                    break
+        else:
+            accepted = [ argmax(await lm.agreedy(tokens+new_tokens), vocab) ]
 
-        new_tokens.append(new_token)
-        probas.append(prob[new_token])
+        for (new_token, logprob) in accepted:
+            new_tokens.append(new_token)
+            probas.append(float(numpy.exp(logprob)))
+            if new_tokens[-len(stop):] == stop:
+                break
 
         if new_tokens[-len(stop):] == stop:
             new_tokens = new_tokens[:-len(stop)]
@@ -10,11 +10,28 @@ import json
 
 fmt_float_or_Nnone = lambda x: 'none' if x is None else '{:.6f}'.format(x)
 
+def normalize(logs:List[float]) -> List[Optional[float]]:
+    """Probabilities relative to the sum over all entries computed from their logarithms (products of many probabilities underflow)"""
+    logs = numpy.asarray(logs, dtype=numpy.double)
+    if len(logs) == 0 or not numpy.isfinite(logs.max()):
+        return [ None ] * len(logs)
+    probas = numpy.exp(logs - logs.max())
+    return (probas / probas.sum()).tolist()
+
+def log(x:float) -> float:
+    with numpy.errstate(divide='ignore'):
+        return float(numpy.log(x))
+
 class FTT_Proba(BaseModel):
     tokens:        List[float] # proba of each token
     tokwise_count: int         # len(tokens) + parent.tokwise_count
     depth:         int = 0     # parent.depth + 1
 
+    # Logarithms of the products (the scores are computed from them)
+    local_log:     float = 0.  # sum(log(tokens))
+    tokwise_log:   float = 0.  # local_log + parent.tokwise_log
+    treewise_log:  Optional[float] = None # log(local_proba) + parent.treewise_log
+
     # Product of local token's probabilities (this node of the tree)
     local_prod:          Optional[float] # prod(tokens)
     local_prod_norm:     Optional[float] # local_prod^(1/len(token))
@@ -29,7 +46,7 @@ class FTT_Proba(BaseModel):
 
     # Product of probabilities of each node on the path
     treewise_prod:       Optional[float] = None # local_proba * parent.treewise_prod
-    treewise_prod_norm:  Optional[float] = None # treewise_prod ^ (1/depth)
+    treewise_prod_norm:  Optional[float] = None # treewise_prod ^ (1/(depth+1))
     treewise_proba:      Optional[float] = None # treewise_prod / sigma(sibling.treewise_prod)
     treewise_proba_norm: Optional[float] = None # treewise_prod_norm / sigma(sibling.treewise_prod_norm)
 
@@ -91,7 +108,7 @@ class FTT_Proba(BaseModel):
                 if tokwise:
                     return lambda proba: proba.tokwise_proba
                 else:
-                    return lambda proba: proba.treewise_roba
+                    return lambda proba: proba.treewise_proba
         else:
             if normalized:
                 if tokwise:
@@ -104,26 +121,37 @@ class FTT_Proba(BaseModel):
                 else:
                     return lambda proba: proba.treewise_prod
     
+    @staticmethod
+    def bound(parent:"FiniteTokenTree", normalized=True, tokwise=True):
+        """Score ranking the children of `parent` as `scoring` does, from the product of the probabilities of a child's tokens and their number"""
+        if normalized and tokwise and parent.probas is not None:
+            (prod, count) = (parent.probas.tokwise_prod, parent.probas.tokwise_count)
+            return lambda local_prod, local_count: numpy.power(prod * local_prod, 1./(count + local_count))
+        else:
+            # The other scores differ between siblings only by their local product (or by a factor common to all siblings)
+            return lambda local_prod, local_count: local_prod
+
     def __init__(self, tokens:List[float], parent:"FiniteTokenTree"):
 
-        local_prod      = numpy.prod(tokens) if len(tokens) > 0 else 1.
-        local_prod_norm = numpy.prod(numpy.power(tokens, 1./len(tokens))) if len(tokens) > 0 else 1.
+        local_log       = sum([ log(p) for p in tokens ])
+        local_prod      = numpy.exp(local_log)
+        local_prod_norm = numpy.exp(local_log / len(tokens)) if len(tokens) > 0 else 1.
 
         if parent.probas is None:
             depth = 0
             tokwise_count = len(tokens)
-            tokwise_prod = local_prod
+            tokwise_log = local_log
             tokwise_prod_norm = local_prod
         else:
             depth = parent.probas.depth + 1
             tokwise_count = len(tokens) + parent.probas.tokwise_count
-            tokwise_prod = local_prod * parent.probas.tokwise_prod
-            tokwise_prod_norm = numpy.power(tokwise_prod, 1./tokwise_count)
+            tokwise_log = local_log + parent.probas.tokwise_log
+            tokwise_prod_norm = numpy.exp(tokwise_log / tokwise_count) if tokwise_count > 0 else 1.
 
         super().__init__(
-            tokens=tokens, tokwise_count=tokwise_count, depth=depth,
+            tokens=tokens, tokwise_count=tokwise_count, depth=depth, local_log=local_log, tokwise_log=tokwise_log,
             local_prod=local_prod, local_prod_norm=local_prod_norm,
-            tokwise_prod=tokwise_prod, tokwise_prod_norm=tokwise_prod_norm
+            tokwise_prod=numpy.exp(tokwise_log), tokwise_prod_norm=tokwise_prod_norm
         )
 
 class FiniteTokenTree(BaseModel):
@@ -160,32 +188,39 @@ class FiniteTokenTree(BaseModel):
         self.children.append(child)
 
     def finalize(self):
-        sum_local_prod = 0.
-        sum_local_prod_norm = 0.
-        sum_tokwise_prod = 0.
-        sum_tokwise_prod_norm = 0.
         for child in self.children:
             assert child.parent is self
-            sum_local_prod        += child.probas.local_prod
-            sum_local_prod_norm   += child.probas.local_prod_norm
-            sum_tokwise_prod      += child.probas.tokwise_prod
-            sum_tokwise_prod_norm += child.probas.tokwise_prod_norm
-        for child in self.children:
-            child.probas.local_proba        = child.probas.local_prod        / sum_local_prod
-            child.probas.local_proba_norm   = child.probas.local_prod_norm   / sum_local_prod_norm
-            child.probas.tokwise_proba      = (child.probas.tokwise_prod      / sum_tokwise_prod     ) if sum_tokwise_prod > 0      else None
-            child.probas.tokwise_proba_norm = (child.probas.tokwise_prod_norm / sum_tokwise_prod_norm) if sum_tokwise_prod_norm > 0 else None
+        probas = [ child.probas for child in self.children ]
+        # Ratios between siblings are computed from the logarithms as the products underflow on long paths
+        for (p, proba) in zip(probas, normalize([ p.local_log for p in probas ])):
+            p.local_proba = proba
+        for (p, proba) in zip(probas, normalize([ p.local_log / max(len(p.tokens), 1) for p in probas ])):
+            p.local_proba_norm = proba
+        for (p, proba) in zip(probas, normalize([ p.tokwise_log for p in probas ])):
+            p.tokwise_proba = proba
+        for (p, proba) in zip(probas, normalize([ log(p.tokwise_prod_norm) for p in probas ])):
+            p.tokwise_proba_norm = proba
+        treewise_log = 0. if self.probas is None or self.probas.treewise_log is None else self.probas.treewise_log
+        for p in probas:
+            p.treewise_log       = (-numpy.inf if p.local_proba is None else log(p.local_proba)) + treewise_log
+            p.treewise_prod      = numpy.exp(p.treewise_log)
+            p.treewise_prod_norm = numpy.exp(p.treewise_log / (p.depth + 1))
+        for (p, proba) in zip(probas, normalize([ p.treewise_log for p in probas ])):
+            p.treewise_proba = proba
+        for (p, proba) in zip(probas, normalize([ p.treewise_log / (p.depth + 1) for p in probas ])):
+            p.treewise_proba_norm = proba
         # TODO treewise_norm_prod
         self.finalized = True
 
     def collect(self, tokens: List[Token] = []):
-        tokens = tokens + self.tokens
-        if len(self.children) == 0 and self.finalized:
-            return [ (tokens, self.probas) ]
-
-        results = []
-        for child in self.children:
-            results += child.collect(tokens=tokens)
+        # Iterative as the trees of deep automata exceed the recursion limit
+        (results, stack) = ([], [ (self, tokens) ])
+        while len(stack) > 0:
+            (tree, tokens) = stack.pop()
+            tokens = tokens + tree.tokens
+            if len(tree.children) == 0 and tree.finalized:
+                results.append((tokens, tree.probas))
+            stack.extend([ (child, tokens) for child in reversed(tree.children) ])
         return results
 
     def results(self, lm, **kwargs):
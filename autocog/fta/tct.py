@@ -3,11 +3,12 @@ from typing import Any, Dict, List, Tuple, Union, Optional, Callable, NamedTuple
 from pydantic import BaseModel
 
 from .vocab import Token
-from .utils import depthfirst
+from .utils import depthfirst, run_sync
 
 from ..lm.lm import LM
 
 import numpy
+import asyncio
 
 class TokenChoiceTree:
     def __init__(self, token=None, depth=0):
@@ -15,6 +16,7 @@ class TokenChoiceTree:
         self.depth = depth
         self.children = {}
         self.proba = None
+        self.pruned = False
 
     def add_tokens(self, sequence:List[int]):
         tok = sequence[0]
@@ -23,18 +25,79 @@ class TokenChoiceTree:
         tree = self.children[tok]
         return tree if len(sequence) == 1 else tree.add_tokens(sequence[1:])
 
-    def eval(self, lm:LM, prompt:List[Token]):
+    def eval(self, lm:LM, prompt:List[Token], width:Optional[int]=None, bound:Optional[Callable[[float,int],float]]=None):
+        return run_sync(self.aeval(lm, prompt, width=width, bound=bound))
+
+    async def aeval(self, lm:LM, prompt:List[Token], width:Optional[int]=None, bound:Optional[Callable[[float,int],float]]=None):
+        """
+        Probabilities of the tokens of each choice, each level of the tree is evaluated with one batch (scoring only the tokens of the children of each node).
+        With `width` and `bound`, only the `width` best choices are returned and the subtrees that cannot contain one of them are not evaluated.
+        `bound(prod, count)` is the score of a choice from the product of the probabilities of its `count` tokens, it must not decrease when either argument increases (for products below one).
+        """
+        if bound is None:
+            width = None
+        best = [] # scores of the complete choices
+        frontier = [ (self, prompt, 1.) ] if len(self.children) > 0 else [] # nodes whose children are not evaluated
+        while len(frontier) > 0:
+            if width is not None and len(best) >= width:
+                # Remaining tokens have a probability of at most one so a choice cannot score more than its prefix with the length of the longest choice below it
+                kth = sorted(best, reverse=True)[width-1]
+                for (tree, prompt_, prod) in frontier:
+                    tree.pruned = bound(prod, tree.longest()) <= kth
+                frontier = [ (tree, prompt_, prod) for (tree, prompt_, prod) in frontier if not tree.pruned ]
+                batch = frontier
+            elif width is not None:
+                # Until `width` choices are complete, only the most promising of the deepest nodes are evaluated (to bound the others early)
+                batch = sorted(frontier, key=lambda x: (x[0].depth, bound(x[2], x[0].longest())), reverse=True)[:width]
+            else:
+                batch = frontier
+            if len(batch) == 0:
+                break
+            frontier = [ entry for entry in frontier if not any([ entry is e for e in batch ]) ]
+            logprobs = await lm.ascore_candidates_batch([ prompt_ for (tree, prompt_, prod) in batch ], [ list(tree.children.keys()) for (tree, prompt_, prod) in batch ])
+            probas = numpy.exp(numpy.concatenate(logprobs)).tolist()
+            children = [ (child, prompt_ + [ child.token ], prod) for (tree, prompt_, prod) in batch for child in tree.children.values() ]
+            children = [ (child, prompt_, prod * proba) for ((child, prompt_, prod), proba) in zip(children, probas) ]
+            for ((child, prompt_, prod), proba) in zip(children, probas):
+                child.proba = proba
+                if len(child.children) == 0 and width is not None:
+                    best.append(bound(prod, child.depth))
+            frontier += [ (child, prompt_, prod) for (child, prompt_, prod) in children if len(child.children) > 0 ]
+        paths = self.paths()
+        if width is not None and len(paths) > width:
+            scores = [ bound(numpy.prod([ p for (t,p) in path ]), len(path)) for path in paths ]
+            paths = [ paths[i] for i in sorted(sorted(range(len(paths)), key=lambda i: -scores[i])[:width]) ]
+        return paths
+
+    def longest(self) -> int:
+        """Depth of the deepest leaf of this subtree"""
+        if len(self.children) == 0:
+            return self.depth
+        return max([ tree.longest() for tree in self.children.values() ])
+
+    def paths(self) -> List[List[Tuple[Token,float]]]:
         if len(self.children) == 0:
             return [ [] ]
-        else:
-            probs = numpy.exp(lm.greedy(prompt))
-
-            results = []
-            for tree in self.children.values():
-                head = [ ( tree.token, probs[tree.token] ) ]
-                tails = tree.eval(lm, prompt+[tree.token])
-                results += [ head + tail for tail in tails ]
-            return results
+        return [ [ ( tree.token, tree.proba ) ] + tail for tree in self.children.values() if not tree.pruned for tail in tree.paths() ]
+
+    def sequences(self) -> List[List[Token]]:
+        if len(self.children) == 0:
+            return [ [] ]
+        return [ [ tree.token ] + tail for tree in self.children.values() for tail in tree.sequences() ]
+
+    def eval_sequences(self, lm:LM, prompt:List[Token]):
+        return run_sync(self.aeval_sequences(lm, prompt))
+
+    async def aeval_sequences(self, lm:LM, prompt:List[Token]):
+        """Same results as `eval` but each choice is scored in one call to the LM (instead of one call per node)"""
+        results = []
+        for sequence in self.sequences():
+            if len(sequence) == 0:
+                results.append([])
+            else:
+                probs = numpy.exp(await lm.ascore_sequence(prompt, sequence))
+                results.append(list(zip(sequence, probs.tolist())))
+        return results
 
     def toGraphViz(self, lm):
         assert self.token is None, "Should be called on the root"
@@ -1,4 +1,7 @@
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 def depthfirst(tree):
     yield tree
     children = tree.children
@@ -8,3 +11,13 @@ def depthfirst(tree):
         if c.parent is None:
             c.parent = tree
         yield from depthfirst(c)
+
+def run_sync(coroutine):
+    """Run a coroutine to completion from synchronous code, on a separate thread when the caller is within a running event loop (Jupyter, coroutines)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # asyncio.run() cannot be nested: the coroutine gets its own loop (the caller blocks as for any synchronous call)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
@@ -3,6 +3,8 @@ from typing import Any, Dict, List, Tuple, Union, Optional, Callable, NamedTuple
 from abc import abstractmethod
 from pydantic import BaseModel
 
+import numpy
+
 Token = int
 
 class Vocab(BaseModel):
@@ -11,35 +13,36 @@ class Vocab(BaseModel):
     bounds: Optional[Tuple[Token,Token]] = None
     ranges: List[Tuple[Token,int]] = []
     tokstr: Optional[List[str]] = None
+    ids: Optional[Any] = None  # sorted array of the tokens
+    masks: Dict[int,Any] = {}  # size of the LM's vocabulary -> additive logit mask
 
     def prepare(self, lm, texts: List[str]):
-        tokens : List[Token] = []
-        for t in texts:
-            tokens += lm.tokenize(t)
-        tokens = list(sorted(set(tokens)))
+        tokens = numpy.unique(numpy.asarray([ tok for t in texts for tok in lm.tokenize(t) ], dtype=numpy.intp))
         assert len(tokens) > 1
-        self.bounds = (tokens[0], tokens[-1])
-        self.tokstr = [ lm.detokenize([t]) for t in tokens ]
-
-        (base,prev) = (tokens[0], tokens[0])
-        for tok in tokens[1:]:
-            if tok == prev + 1:
-                prev += 1
-            else:
-                self.ranges.append( (base, prev-base+1) )
-                prev = tok
-        self.ranges.append( (base, prev-base+1) )
+        self.ids = tokens
+        self.masks = {}
+        self.bounds = (int(tokens[0]), int(tokens[-1]))
+        self.tokstr = [ lm.detokenize([t]) for t in tokens.tolist() ]
+
+        starts = numpy.concatenate([ [0], numpy.flatnonzero(numpy.diff(tokens) != 1) + 1 ])
+        lengths = numpy.diff(numpy.concatenate([ starts, [len(tokens)] ]))
+        self.ranges = list(zip(tokens[starts].tolist(), lengths.tolist()))
+
+    def mask(self, size:int) -> numpy.ndarray:
+        """Float32 array added to logits (or logprobs) over a vocabulary of `size` tokens: 0 for the tokens of this Vocab and -inf for the others"""
+        if not size in self.masks:
+            mask = numpy.full(size, -numpy.inf, dtype=numpy.single)
+            mask[self.ids] = 0.
+            self.masks.update({ size : mask })
+        return self.masks[size]
 
     def has(self, tok:Token) -> bool:
         if self.bounds is None:
             return True # No range => full voc
         if tok < self.bounds[0] or tok > self.bounds[1]:
             return False
-
-        for (b,l) in self.ranges:
-            if tok >= b and tok < b + l:
-                return True
-        return False
+        idx = numpy.searchsorted(self.ids, tok)
+        return idx < len(self.ids) and self.ids[idx] == tok
 
     def toGraphVizLabel(self):
         return 'FULL' if len(self.ranges) == 0 else ', '.join(self.tokstr)
@@ -1,4 +1,23 @@
 
-from .random import RLM
-from .llama import Llama
-from .transformers import TfLM
+import importlib
+
+# Backends are only imported when used: `llama_cpp`, `torch`, and `transformers` are slow to import
+backends = {
+    'random'       : ( '.random',       'RLM'   ),
+    'llama'        : ( '.llama',        'Llama' ),
+    'transformers' : ( '.transformers', 'TfLM'  ),
+    'pool'         : ( '.pool',         'PoolLM' ),
+    'replay'       : ( '.trace',        'Replay' ),
+}
+
+def backend(name:str):
+    if not name in backends:
+        raise Exception(f"Unknown LM backend: {name} (expect one of {', '.join(backends.keys())})")
+    (module, cls) = backends[name]
+    return getattr(importlib.import_module(module, __name__), cls)
+
+def __getattr__(name:str):
+    for (module, cls) in backends.values():
+        if cls == name:
+            return getattr(importlib.import_module(module, __name__), cls)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
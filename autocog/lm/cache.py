@@ -0,0 +1,133 @@
+
+from typing import Any, Dict, List, Tuple, Union, Optional, Callable
+from collections import OrderedDict
+
+from .lm import common_prefix
+
+class RadixTree:
+    def __init__(self, tokens:Tuple[int,...]=(), parent:Optional["RadixTree"]=None):
+        self.tokens = tokens # label of the edge from the parent
+        self.parent = parent
+        self.children = {}   # first token of the edge -> subtree
+        self.key = None      # set when an entry is stored at this node
+        self.count = 0       # number of entries stored in this subtree
+
+    def update_count(self, delta:int):
+        tree = self
+        while tree is not None:
+            tree.count += delta
+            tree = tree.parent
+
+    def insert(self, tokens:Tuple[int,...]) -> "RadixTree":
+        if len(tokens) == 0:
+            return self
+        child = self.children.get(tokens[0])
+        if child is None:
+            child = RadixTree(tokens=tokens, parent=self)
+            self.children.update({ tokens[0] : child })
+            return child
+        length = common_prefix(child.tokens, tokens)
+        if length < len(child.tokens):
+            # Split the edge: `child` becomes the child of a new node holding the shared part
+            split = RadixTree(tokens=child.tokens[:length], parent=self)
+            split.count = child.count
+            self.children.update({ tokens[0] : split })
+            child.tokens = child.tokens[length:]
+            child.parent = split
+            split.children.update({ child.tokens[0] : child })
+            child = split
+        return child.insert(tokens[length:])
+
+    def prune(self):
+        if self.parent is None or self.key is not None:
+            return
+        if len(self.children) == 0:
+            del self.parent.children[self.tokens[0]]
+            self.parent.prune()
+        elif len(self.children) == 1:
+            # Merge with the only child to keep edges maximal
+            child = list(self.children.values())[0]
+            child.tokens = self.tokens + child.tokens
+            child.parent = self.parent
+            self.parent.children.update({ self.tokens[0] : child })
+
+    def match(self, tokens:Tuple[int,...], depth:int=0) -> Tuple[int,Optional["RadixTree"]]:
+        """Deepest subtree containing an entry that shares a prefix with `tokens` and the length of that prefix"""
+        best = (depth, self) if self.count > 0 else (0, None)
+        if depth == len(tokens):
+            return best
+        child = self.children.get(tokens[depth])
+        if child is None or child.count == 0:
+            return best
+        length = common_prefix(child.tokens, tokens[depth:depth+len(child.tokens)])
+        if length < len(child.tokens):
+            return (depth + length, child)
+        return child.match(tokens, depth + length)
+
+    def first(self) -> "RadixTree":
+        tree = self
+        while tree.key is None:
+            tree = next(filter(lambda c: c.count > 0, tree.children.values()))
+        return tree
+
+class PromptCache:
+    """
+    Radix trees keyed by token ids mapping prompts to cached values (logprob rows, KV states, ...).
+    All kinds of values share one memory budget (in bytes) and the least recently used entries are evicted first.
+    """
+    def __init__(self, budget:int):
+        self.budget = budget
+        self.usage = 0
+        self.trees = {}
+        self.entries = OrderedDict() # (kind, tokens) -> (tree, value, nbytes)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind:str, tokens:List[int]) -> Any:
+        key = (kind, tuple(tokens))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][1]
+        self.misses += 1
+        return None
+
+    def match(self, kind:str, tokens:List[int]) -> Tuple[int,Any]:
+        """Value stored under the key sharing the longest prefix with `tokens` and the length of that prefix"""
+        if not kind in self.trees:
+            return (0, None)
+        (length, tree) = self.trees[kind].match(tuple(tokens))
+        if tree is None or length == 0:
+            return (0, None)
+        key = tree.first().key
+        self.entries.move_to_end(key)
+        return (length, self.entries[key][1])
+
+    def insert(self, kind:str, tokens:List[int], value:Any, nbytes:int):
+        key = (kind, tuple(tokens))
+        nbytes += 8 * len(key[1])
+        if nbytes > self.budget:
+            return
+        if key in self.entries:
+            self.remove(key)
+        if not kind in self.trees:
+            self.trees.update({ kind : RadixTree() })
+        tree = self.trees[kind].insert(key[1])
+        tree.key = key
+        tree.update_count(1)
+        self.entries.update({ key : (tree, value, nbytes) })
+        self.usage += nbytes
+        while self.usage > self.budget:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key:Tuple[str,Tuple[int,...]]):
+        (tree, value, nbytes) = self.entries.pop(key)
+        self.usage -= nbytes
+        tree.key = None
+        tree.update_count(-1)
+        tree.prune()
+
+    def clear(self):
+        self.usage = 0
+        self.trees.clear()
+        self.entries.clear()
@@ -1,6 +1,16 @@
 
 from typing import Any, Dict, List, Tuple, Union, Optional, Callable
-from .lm import LM
+from .lm import LM, common_prefix, log_softmax, logsumexp, clear_caches
+from .store import fingerprint_file
+
+import os
+import mmap
+import json
+import struct
+import hashlib
+import numpy
+from contextlib import nullcontext
+from collections import OrderedDict
 
 try:
     import llama_cpp
@@ -8,19 +18,137 @@ except:
     llama_cpp = "Package `llama_cpp` needed for LLaMa wrapper (pip install git+https://github.com/tristanvdb/llama-cpp-python@choice-dev)"
     print(f"Warning: {llama_cpp}")
 
+def write_state(path:str, state:Any):
+    """Save a `LlamaState` as a JSON header (attributes and layout) followed by the raw content of its arrays and bytes"""
+    (header, blobs, offset) = ({}, [], 0)
+    for (name, value) in vars(state).items():
+        if isinstance(value, numpy.ndarray):
+            header.update({ name : { 'dtype' : value.dtype.str, 'shape' : value.shape, 'offset' : offset } })
+            blobs.append(numpy.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (bytes, bytearray)) or hasattr(value, '_type_'):
+            header.update({ name : { 'bytes' : True, 'offset' : offset } })
+            blobs.append(bytes(value))
+        else:
+            header.update({ name : { 'value' : value } })
+            continue
+        header[name].update({ 'size' : len(blobs[-1]) })
+        offset += len(blobs[-1])
+    header = json.dumps(header).encode()
+    # Written next to the destination then renamed so concurrent processes never read a partial file
+    with open(path + f'.{os.getpid()}', 'wb') as F:
+        F.write(struct.pack('<Q', len(header)))
+        F.write(header)
+        for blob in blobs:
+            F.write(blob)
+    os.replace(path + f'.{os.getpid()}', path)
+
+def read_state(path:str) -> Any:
+    """Memory-map a state saved by `write_state` (copy-on-write so the file is never modified)"""
+    with open(path, 'rb') as F:
+        data = mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_COPY)
+    (size,) = struct.unpack('<Q', data[:8])
+    header = json.loads(data[8:8+size])
+    start = 8 + size
+    state = llama_cpp.LlamaState.__new__(llama_cpp.LlamaState)
+    for (name, attr) in header.items():
+        if 'value' in attr:
+            value = attr['value']
+        elif 'bytes' in attr:
+            value = memoryview(data)[start+attr['offset']:start+attr['offset']+attr['size']]
+        else:
+            value = numpy.frombuffer(data, dtype=numpy.dtype(attr['dtype']), count=int(numpy.prod(attr['shape'])), offset=start+attr['offset']).reshape(attr['shape'])
+        setattr(state, name, value)
+    return state
+
 class Llama(LM):
     model: Any
+    model_path: str
+    model_kwargs: Dict[str,Any]
+    logits_all: bool
+    digest: str
+    snapshot: int = 256 # minimum number of discarded tokens for the KV state to be saved in the cache before a rollback
+    registry: Optional[Any] = None # ModelRegistry managing the memory used by this model
+    states: Optional[str] = None   # directory where the states following the headers of the prompts are persisted
+    headers: Any = None            # key -> (tokens, state) for the headers loaded from `states` (least recently used first)
+    max_headers: int = 8           # number of header states kept in memory (the others are read again from `states` when needed)
+    stale: int = 0                 # rows of llama.cpp's scores buffer before this index are not valid (header states only keep their last row)
 
-    def __init__(self, model_path:str, logits_all=True, verbose=False, n_ctx=2048, **kwargs):
+    def __init__(self, model_path:str, logits_all=True, verbose=False, n_ctx=2048, lazy=False, **kwargs):
         if isinstance(llama_cpp,str):
             raise Exception(f"Error: {llama_cpp}")
         super().__init__(
-            model=llama_cpp.Llama(model_path=model_path, logits_all=logits_all, verbose=verbose, n_ctx=n_ctx), **kwargs
+            model=None, model_path=model_path, model_kwargs={ 'logits_all' : logits_all, 'verbose' : verbose, 'n_ctx' : n_ctx },
+            logits_all=logits_all, digest=fingerprint_file(model_path), headers=OrderedDict(), **kwargs
         )
+        if not lazy:
+            self.load()
+
+    def load(self):
+        """Load the weights (memory-mapped by llama.cpp) if they are not, called before any use of `self.model`"""
+        with nullcontext() if self.registry is None else self.registry.lock:
+            if self.model is None:
+                if self.registry is not None:
+                    self.registry.reserve(self)
+                self.model = llama_cpp.Llama(model_path=self.model_path, **self.model_kwargs)
+            if self.registry is not None:
+                self.registry.touch(self)
+            return self.model
+
+    def pinned(self):
+        """Context in which the registry cannot unload the model"""
+        return nullcontext() if self.registry is None else self.registry.pin(self)
+
+    def retry(self, name:str, impl:Callable, *args):
+        with self.pinned():
+            return super().retry(name, impl, *args)
 
     def tokenize(self, text:str, whole:bool=True) -> List[int]:
+        with self.pinned():
+            return super().tokenize(text, whole)
+
+    def detokenize(self, tokens:List[int], whole:bool=True) -> str:
+        with self.pinned():
+            return super().detokenize(tokens, whole)
+
+    def unload(self):
+        self.headers.clear()
+        self.stale = 0
+        if self.model is not None:
+            if hasattr(self.model, 'close'):
+                self.model.close()
+            self.model = None
+            clear_caches()
+
+    def fingerprint(self) -> Optional[str]:
+        return self.digest
+
+    def needs_prefill(self, key:str) -> bool:
+        return self.states is not None and not key in self.headers
+
+    def prefill(self, tokens:List[int], key:str):
+        if not self.needs_prefill(key):
+            return
+        with self.pinned():
+            self.load()
+            digest = hashlib.sha256(numpy.asarray(tokens, dtype=numpy.int32).tobytes()).hexdigest()
+            path = os.path.join(self.states, hashlib.sha256(f"{self.digest}:{key}:{digest}".encode()).hexdigest() + '.state')
+            if os.path.exists(path):
+                state = read_state(path)
+            else:
+                self.evaluate(tokens)
+                state = self.model.save_state()
+                # Only the logits following the header are used, llama.cpp broadcasts the single row when the state is loaded
+                state.scores = state.scores[state.n_tokens-1:state.n_tokens].copy()
+                os.makedirs(self.states, exist_ok=True)
+                write_state(path, state)
+            self.headers.update({ key : (list(tokens), state) })
+            while len(self.headers) > self.max_headers:
+                self.headers.popitem(last=False)
+
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
         if not isinstance(text,str):
             raise Exception(f'text={text}')
+        self.load()
 
         if text == '\n':
             return [ self.model.token_nl() ]
@@ -39,7 +167,8 @@ class Llama(LM):
         else:
             return tokens
 
-    def detokenize(self, tokens:List[int], whole:bool=True) -> str:
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
+        self.load()
         if not whole:
             tokens = [ self.model.token_nl() ] + tokens
         tokens = [ self.model.token_bos() ] + tokens + [ self.model.token_eos() ]
@@ -48,6 +177,86 @@ class Llama(LM):
             text = text[:-len('<|im_end|>')]
         return text
 
-    def impl_greedy(self, prompt: Union[str,List[int]]) -> List[float]:
-        output = self.model.create_completion(prompt, max_tokens=1, logprobs=-1, full_logprobs=True)
-        return output['choices'][0]['logprobs'][0]
+    def rollback(self, tokens:List[int], count:int=1):
+        """Truncate the evaluated tokens (and KV cache) to the longest prefix shared with `tokens` (keeping valid logits for the last `count` tokens)"""
+        evaluated = self.model.input_ids[:self.model.n_tokens]
+        prefix = common_prefix(evaluated, tokens)
+        if self.cache is not None:
+            # Save the current state before discarding a large part of it (typically when switching prompt or job)
+            if self.model.n_tokens - prefix >= self.snapshot and self.cache.match('state', evaluated)[0] < len(evaluated):
+                state = self.model.save_state()
+                self.cache.insert('state', evaluated.tolist(), (state, self.stale), state.llama_state_size + state.input_ids.nbytes + state.scores.nbytes)
+            (length, entry) = self.cache.match('state', tokens)
+            if length > prefix:
+                self.model.load_state(entry[0])
+                self.stale = entry[1]
+                prefix = common_prefix(self.model.input_ids[:self.model.n_tokens], tokens)
+        for (key, (header, state)) in list(self.headers.items()):
+            if common_prefix(header, tokens) > prefix:
+                self.model.load_state(state)
+                self.stale = max(state.n_tokens - len(state.scores), 0)
+                self.headers.move_to_end(key)
+                prefix = common_prefix(self.model.input_ids[:self.model.n_tokens], tokens)
+        if prefix == len(tokens) and not self.logits_all:
+            prefix -= 1 # only the logits of the last evaluated token are available
+        if len(tokens) - count < self.stale:
+            prefix = min(prefix, len(tokens) - count) # re-evaluated to replace the stale logits
+        self.stale = min(self.stale, prefix)
+        self.model.n_tokens = prefix
+
+    def evaluate(self, prompt: Union[str,List[int]], count:int=1) -> numpy.ndarray:
+        """View of the logits (in llama.cpp's scores buffer) following each of the last `count` tokens of `prompt`"""
+        self.load()
+        if isinstance(prompt, str):
+            prompt = self.model.tokenize(bytes(prompt, 'utf-8'))
+        if len(prompt) == 0:
+            raise Exception("Cannot evaluate an empty prompt")
+        if len(prompt) > self.model.n_ctx():
+            raise Exception(f"Prompt of {len(prompt)} tokens does not fit in context of {self.model.n_ctx()} tokens")
+        if count > 1 and not self.logits_all:
+            raise Exception("Logits of more than one position require `logits_all`")
+
+        self.rollback(prompt, count)
+        if self.model.n_tokens < len(prompt):
+            # `eval` removes the KV cache entries past `n_tokens` before extending it
+            self.model.eval(prompt[self.model.n_tokens:])
+        return self.model.scores[len(prompt)-count:len(prompt)]
+
+    def impl_greedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        # Single copy out of the scores buffer as its rows are read again when the KV cache is reused
+        return log_softmax(self.evaluate(prompt)[0])
+
+    def impl_score_candidates(self, prompt: Union[str,List[int]], tokens: numpy.ndarray) -> numpy.ndarray:
+        logits = self.evaluate(prompt)[0]
+        return logits[tokens] - logsumexp(logits)
+
+    def impl_score_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[numpy.ndarray]) -> List[numpy.ndarray]:
+        self.load()
+        prompts = [ self.model.tokenize(bytes(prompt, 'utf-8')) if isinstance(prompt, str) else prompt for prompt in prompts ]
+        # Lexicographic order places prompts with shared prefixes next to each other so the KV cache is reused
+        results = [ None ] * len(prompts)
+        for i in sorted(range(len(prompts)), key=lambda i: prompts[i]):
+            logits = self.evaluate(prompts[i])[0]
+            results[i] = logits[tokens[i]] - logsumexp(logits)
+        return results
+
+    def impl_greedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        if not self.logits_all:
+            return super().impl_greedy_tail(prompt, count)
+        return log_softmax(self.evaluate(prompt, count))
+
+    def impl_score_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        if not self.logits_all:
+            return super().impl_score_sequence(prompt, continuation)
+        logits = self.evaluate(list(prompt) + list(continuation[:-1]), len(continuation))
+        return logits[numpy.arange(len(continuation)), continuation] - logsumexp(logits)
+
+    def impl_greedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        self.load()
+        prompts = [ self.model.tokenize(bytes(prompt, 'utf-8')) if isinstance(prompt, str) else prompt for prompt in prompts ]
+        # Lexicographic order places prompts with shared prefixes next to each other so the KV cache is reused
+        order = sorted(range(len(prompts)), key=lambda i: prompts[i])
+        results = numpy.empty((len(prompts), self.model.n_vocab()), dtype=numpy.single)
+        for i in order:
+            log_softmax(self.evaluate(prompts[i])[0], out=results[i])
+        return results
@@ -5,48 +5,229 @@ from pydantic import BaseModel
 
 
 import gc
+import sys
 import time
-
-try:
-    import torch
-except:
-    torch = None
+import numpy
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 def clear_caches():
     gc.collect()
-    if torch is not None:
+    # No need to import `torch` if no backend did
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
         torch.cuda.empty_cache()
 
+def log_softmax(logits, out=None):
+    """Log-softmax over the last axis as float32, computed in `out` (can be `logits` itself) to avoid intermediate arrays"""
+    if out is None:
+        out = numpy.array(logits, dtype=numpy.single)
+    elif out is not logits:
+        out[...] = logits
+    out -= out.max(axis=-1, keepdims=True)
+    out -= numpy.log(numpy.exp(out).sum(axis=-1, keepdims=True))
+    return out
+
+def logsumexp(logits) -> numpy.ndarray:
+    """Normalizer of the logits over the last axis: log(sum(exp(logits)))"""
+    maxi = logits.max(axis=-1, keepdims=True)
+    return (maxi + numpy.log(numpy.exp(logits - maxi).sum(axis=-1, keepdims=True)))[...,0]
+
+def common_prefix(lhs, rhs) -> int:
+    """Length of the longest common prefix of two sequences of tokens"""
+    size = min(len(lhs), len(rhs))
+    diff = numpy.flatnonzero(numpy.asarray(lhs[:size]) != numpy.asarray(rhs[:size]))
+    return size if len(diff) == 0 else int(diff[0])
+
 class LM(BaseModel):
     model: Any
 
     retries:int=3
     delta:float=1.
     growth:float=4.
-    
+
+    cache: Optional[Any] = None # PromptCache shared by all the prompts scored with this LM
+    store: Optional[Any] = None # LogprobStore persisting the logprobs across processes
+
+    threads: int = 1            # size of the executor running the calls of the async methods (models are not thread-safe)
+    executor: Optional[Any] = None
+
+    memo_size: int = 4096       # maximum number of entries memoized by `tokenize` and by `detokenize` (0 to disable)
+    tokenized: Any = None
+    detokenized: Any = None
+    memo_hits: int = 0
+    memo_misses: int = 0
+
+    requests: int = 0           # number of calls to the implementation (excluding the hits of `cache` and `store`)
+
     @abstractmethod
-    def tokenize(self, text:str, whole:bool=True) -> List[int]:
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
         """"""
 
     @abstractmethod
-    def detokenize(self, tokens:List[int], whole:bool=True) -> str:
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
         """"""
 
+    def memoize(self, memo:OrderedDict, key:Any, impl:Callable, *args):
+        value = memo.get(key)
+        if value is None:
+            self.memo_misses += 1
+            value = impl(*args)
+            memo.update({ key : value })
+            if len(memo) > self.memo_size:
+                memo.popitem(last=False)
+        else:
+            self.memo_hits += 1
+            memo.move_to_end(key)
+        return value
+
+    def tokenize(self, text:str, whole:bool=True) -> List[int]:
+        if self.memo_size <= 0:
+            return self.impl_tokenize(text, whole)
+        if self.tokenized is None:
+            self.tokenized = OrderedDict()
+        # Copy as callers extend the lists of tokens
+        return list(self.memoize(self.tokenized, (text, whole), self.impl_tokenize, text, whole))
+
+    def detokenize(self, tokens:List[int], whole:bool=True) -> str:
+        if self.memo_size <= 0:
+            return self.impl_detokenize(tokens, whole)
+        if self.detokenized is None:
+            self.detokenized = OrderedDict()
+        return self.memoize(self.detokenized, (tuple(tokens), whole), self.impl_detokenize, tokens, whole)
+
     @abstractmethod
-    def impl_greedy(self, prompt:str):
-        """"""
+    def impl_greedy(self, prompt:Union[str,List[int]]) -> numpy.ndarray:
+        """Float32 array of the logprobs of the next token (callers must not modify it)"""
+
+    def impl_greedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        return numpy.stack([ self.impl_greedy(prompt) for prompt in prompts ])
+
+    def impl_score_candidates(self, prompt: Union[str,List[int]], tokens: numpy.ndarray) -> numpy.ndarray:
+        return self.impl_greedy(prompt)[tokens]
+
+    def impl_score_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[numpy.ndarray]) -> List[numpy.ndarray]:
+        return [ self.impl_score_candidates(prompt, tokens_) for (prompt, tokens_) in zip(prompts, tokens) ]
+
+    def impl_greedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        return numpy.stack([ self.impl_greedy(prompt[:len(prompt)-count+i+1]) for i in range(count) ])
 
-    def greedy(self, prompt: Union[str,List[int]]):
+    def impl_score_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        logprobs = self.impl_greedy_tail(list(prompt) + list(continuation[:-1]), len(continuation))
+        return logprobs[numpy.arange(len(continuation)), continuation]
+
+    def needs_prefill(self, key:str) -> bool:
+        return False
+
+    def prefill(self, tokens:List[int], key:str):
+        """Hint that many prompts start with `tokens` (identified by `key`), backends can precompute (and persist) the corresponding state"""
+
+    def retry(self, name:str, impl:Callable, *args):
+        self.requests += 1
         delta = self.delta
         errors = []
         while len(errors) < self.retries:
             try:
-                return self.impl_greedy(prompt)
+                return impl(*args)
             except Exception as e:
                 errors.append(e)
+                if len(errors) == self.retries:
+                    break
                 time.sleep(delta)
                 clear_caches()
                 delta *= self.growth
         params = f"retries={self.retries}, delta={self.delta}s, growth={self.growth}x"
         errors = '\n - '.join(list(set(map(str,errors))))
-        raise Exception(f"Persisting exception when calling {self.__class__.__name__}.greedy()\n  => {params}\n - {errors}")
+        raise Exception(f"Persisting exception when calling {self.__class__.__name__}.{name}()\n  => {params}\n - {errors}")
+
+    def fingerprint(self) -> Optional[str]:
+        """Identifies the model in persistent stores, `None` when its output is not deterministic"""
+        return None
+
+    def lookup(self, prompt: List[int]):
+        logprobs = None if self.cache is None else self.cache.get('greedy', prompt)
+        if logprobs is None and self.store is not None and self.fingerprint() is not None:
+            logprobs = self.store.get(self.fingerprint(), prompt)
+            if logprobs is not None and self.cache is not None:
+                self.cache.insert('greedy', prompt, logprobs, logprobs.nbytes)
+        return logprobs
+
+    def record(self, prompt: List[int], logprobs) -> numpy.ndarray:
+        """Memoize the logprobs and return them as later lookups will (the store only keeps the top-k)"""
+        if self.store is not None and self.fingerprint() is not None:
+            logprobs = self.store.put(self.fingerprint(), prompt, logprobs)
+        if self.cache is not None:
+            self.cache.insert('greedy', prompt, logprobs, logprobs.nbytes)
+        return logprobs
+
+    def greedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        if isinstance(prompt, str) or (self.cache is None and self.store is None):
+            return self.retry('greedy', self.impl_greedy, prompt)
+        logprobs = self.lookup(prompt)
+        if logprobs is None:
+            logprobs = self.record(prompt, self.retry('greedy', self.impl_greedy, prompt))
+        return logprobs
+
+    def greedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        """Logprobs of the next token for each prompt as an array of shape [len(prompts), vocab]"""
+        if any([ isinstance(prompt, str) for prompt in prompts ]) or (self.cache is None and self.store is None):
+            return self.retry('greedy_batch', self.impl_greedy_batch, prompts)
+        cached = [ self.lookup(prompt) for prompt in prompts ]
+        missing = [ i for (i,logprobs) in enumerate(cached) if logprobs is None ]
+        if len(missing) > 0:
+            logprobs = self.retry('greedy_batch', self.impl_greedy_batch, [ prompts[i] for i in missing ])
+            for (i,row) in zip(missing, logprobs):
+                cached[i] = self.record(prompts[i], row.copy()) # do not keep the whole batch alive
+        return numpy.stack(cached)
+
+    def score_candidates(self, prompt: Union[str,List[int]], tokens: List[int]) -> numpy.ndarray:
+        """Logprobs of the next token restricted to `tokens` (still normalized over the whole vocabulary)"""
+        tokens = numpy.asarray(tokens, dtype=numpy.intp)
+        if not isinstance(prompt, str) and (self.cache is not None or self.store is not None):
+            # Full rows are memoized to be reused by other prompts
+            return self.greedy(prompt)[tokens]
+        return self.retry('score_candidates', self.impl_score_candidates, prompt, tokens)
+
+    def score_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[List[int]]) -> List[numpy.ndarray]:
+        """Same as `score_candidates` for each prompt (and its candidates) in one call"""
+        tokens = [ numpy.asarray(tokens_, dtype=numpy.intp) for tokens_ in tokens ]
+        if not any([ isinstance(prompt, str) for prompt in prompts ]) and (self.cache is not None or self.store is not None):
+            return [ row[tokens_] for (row, tokens_) in zip(self.greedy_batch(prompts), tokens) ]
+        return self.retry('score_candidates_batch', self.impl_score_candidates_batch, prompts, tokens)
+
+    def greedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        """Logprobs following each of the last `count` tokens of `prompt`, array of shape [count, vocab]"""
+        return self.retry('greedy_tail', self.impl_greedy_tail, prompt, count)
+
+    def score_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        """Logprobs of each token of `continuation` following `prompt` (a single evaluation for backends keeping all logits)"""
+        return self.retry('score_sequence', self.impl_score_sequence, prompt, continuation)
+
+    async def arun(self, method:Callable, *args):
+        """Run a (blocking) method in the executor of this LM so the event loop keeps running other coroutines"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=self.__class__.__name__)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def aprefill(self, tokens:List[int], key:str):
+        if self.needs_prefill(key):
+            await self.arun(self.prefill, tokens, key)
+
+    async def agreedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        return await self.arun(self.greedy, prompt)
+
+    async def agreedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        return await self.arun(self.greedy_batch, prompts)
+
+    async def ascore_candidates(self, prompt: Union[str,List[int]], tokens: List[int]) -> numpy.ndarray:
+        return await self.arun(self.score_candidates, prompt, tokens)
+
+    async def ascore_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[List[int]]) -> List[numpy.ndarray]:
+        return await self.arun(self.score_candidates_batch, prompts, tokens)
+
+    async def agreedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        return await self.arun(self.greedy_tail, prompt, count)
+
+    async def ascore_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        return await self.arun(self.score_sequence, prompt, continuation)
@@ -0,0 +1,187 @@
+
+from typing import Any, Dict, List, Tuple, Union, Optional, Callable
+from .lm import LM, common_prefix
+
+from multiprocessing import shared_memory
+import multiprocessing
+import threading
+import atexit
+import time
+
+import numpy
+
+def serve(connection, name:str, kwargs:Dict[str,Any]):
+    """Loop of a worker process: calls the methods of its LM and writes the arrays in the shared buffer provided by the proxy"""
+    from . import backend
+    try:
+        lm = backend(name)(**kwargs)
+    except Exception as e:
+        connection.send(('error', f"{e.__class__.__name__}: {e}"))
+        return
+    connection.send(('ready', lm.fingerprint()))
+    buffer = None
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        (method, args) = request
+        try:
+            result = getattr(lm, method)(*args)
+        except Exception as e:
+            connection.send(('error', f"{e.__class__.__name__}: {e}"))
+            continue
+        # Lists of arrays (one per prompt of a batch) are sent concatenated
+        sizes = None
+        if isinstance(result, list) and len(result) > 0 and all([ isinstance(r, numpy.ndarray) for r in result ]):
+            (sizes, result) = ([ len(r) for r in result ], numpy.concatenate(result))
+        if not isinstance(result, numpy.ndarray):
+            connection.send(('value', result))
+            continue
+        result = numpy.asarray(result, dtype=numpy.single)
+        if buffer is None or buffer.size < result.nbytes:
+            connection.send(('resize', result.nbytes))
+            if buffer is not None:
+                buffer.close()
+            buffer = shared_memory.SharedMemory(name=connection.recv())
+        numpy.ndarray(result.shape, dtype=numpy.single, buffer=buffer.buf)[...] = result
+        connection.send(('array', result.shape, sizes))
+    if buffer is not None:
+        buffer.close()
+
+class Worker:
+    def __init__(self, context, name:str, kwargs:Dict[str,Any]):
+        (self.connection, child) = context.Pipe()
+        self.process = context.Process(target=serve, args=(child, name, kwargs), daemon=True)
+        self.process.start()
+        child.close()
+        self.buffer = None
+        self.busy = False
+        self.tokens = []   # last prompt evaluated by this worker (approximates the content of its KV cache)
+        self.last = 0.
+
+    def ready(self) -> Optional[str]:
+        (status, value) = self.connection.recv()
+        if status == 'error':
+            raise Exception(f"LM worker failed to start: {value}")
+        return value
+
+    def call(self, method:str, *args):
+        self.connection.send((method, args))
+        reply = self.connection.recv()
+        if reply[0] == 'resize':
+            self.resize(reply[1])
+            self.connection.send(self.buffer.name)
+            reply = self.connection.recv()
+        if reply[0] == 'error':
+            raise Exception(reply[1])
+        elif reply[0] == 'value':
+            return reply[1]
+        # Copied out of the buffer as it is overwritten by the next call
+        result = numpy.ndarray(reply[1], dtype=numpy.single, buffer=self.buffer.buf).copy()
+        return result if reply[2] is None else numpy.split(result, numpy.cumsum(reply[2])[:-1])
+
+    def resize(self, nbytes:int):
+        self.release()
+        # Rounded up to limit the number of reallocations as batches grow
+        self.buffer = shared_memory.SharedMemory(create=True, size=2**max(int(nbytes-1).bit_length(), 12))
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer.unlink()
+            self.buffer = None
+
+    def stop(self):
+        if self.process.is_alive():
+            self.connection.send(None)
+            self.process.join(timeout=5)
+        self.release()
+
+class PoolLM(LM):
+    """
+    Proxy dispatching the calls to worker processes each holding an instance of an LM backend (created from `model_kwargs`).
+    Calls from concurrent threads run in parallel, each is sent to the idle worker whose last prompt shares the longest prefix (to reuse its KV cache).
+    """
+    backend: str
+    digest: Optional[str] = None
+    condition: Any = None
+    prefilled: List[str] = []
+
+    def __init__(self, backend:str, model_kwargs:Dict[str,Any], size:int=2, **kwargs):
+        context = multiprocessing.get_context('spawn')
+        workers = [ Worker(context, backend, model_kwargs) for w in range(size) ]
+        digests = [ worker.ready() for worker in workers ]
+        super().__init__(model=workers, backend=backend, digest=digests[0], condition=threading.Condition(), threads=size, **kwargs)
+        atexit.register(self.close)
+
+    def close(self):
+        for worker in self.model:
+            worker.stop()
+
+    def fingerprint(self) -> Optional[str]:
+        return self.digest
+
+    def acquire(self, prompt:Union[str,List[int]]) -> Worker:
+        prompt = [] if isinstance(prompt, str) else prompt
+        with self.condition:
+            while all([ worker.busy for worker in self.model ]):
+                self.condition.wait()
+            # Longest shared prefix first then least recently used
+            worker = max(filter(lambda w: not w.busy, self.model), key=lambda w: (common_prefix(w.tokens, prompt), -w.last))
+            worker.busy = True
+            return worker
+
+    def release(self, worker:Worker, prompt:Union[str,List[int]]):
+        with self.condition:
+            if not isinstance(prompt, str) and len(prompt) > 0:
+                worker.tokens = list(prompt)
+            worker.last = time.monotonic()
+            worker.busy = False
+            self.condition.notify_all()
+
+    def dispatch(self, prompt:Union[str,List[int]], method:str, *args):
+        worker = self.acquire(prompt)
+        try:
+            return worker.call(method, *args)
+        finally:
+            self.release(worker, prompt)
+
+    def needs_prefill(self, key:str) -> bool:
+        return not key in self.prefilled
+
+    def prefill(self, tokens:List[int], key:str):
+        """Sent to every worker (the first one computes the state, the others load it if it is persisted)"""
+        for worker in self.model:
+            with self.condition:
+                while worker.busy:
+                    self.condition.wait()
+                worker.busy = True
+            try:
+                worker.call('prefill', list(tokens), key)
+            finally:
+                self.release(worker, tokens)
+        self.prefilled.append(key)
+
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
+        return self.dispatch('', 'tokenize', text, whole)
+
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
+        return self.dispatch('', 'detokenize', list(tokens), whole)
+
+    def impl_greedy(self, prompt:Union[str,List[int]]) -> numpy.ndarray:
+        return self.dispatch(prompt, 'greedy', prompt)
+
+    def impl_greedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        return self.dispatch(prompts[-1], 'greedy_batch', prompts)
+
+    def impl_score_candidates(self, prompt: Union[str,List[int]], tokens: numpy.ndarray) -> numpy.ndarray:
+        return self.dispatch(prompt, 'score_candidates', prompt, tokens.tolist())
+
+    def impl_score_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[numpy.ndarray]) -> List[numpy.ndarray]:
+        return self.dispatch(prompts[-1], 'score_candidates_batch', prompts, [ tokens_.tolist() for tokens_ in tokens ])
+
+    def impl_greedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        return self.dispatch(prompt, 'greedy_tail', list(prompt), count)
+
+    def impl_score_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        return self.dispatch(list(prompt) + list(continuation), 'score_sequence', list(prompt), list(continuation))
@@ -1,24 +1,96 @@
 
 from typing import Any, Dict, List, Tuple, Union, Optional, Callable, NamedTuple
-from .lm import LM
+from .lm import LM, common_prefix, log_softmax
 
+import time
 import numpy
+import hashlib
 
 class RLM(LM):
+    """
+    Synthetic LM for tests and benchmarks. Without `seed` the logprobs are uniform noise.
+    With `seed` they are derived from a hash of the prompt (reproducible across runs and processes) and the cost of a model can be simulated:
+    each call sleeps `latency` plus `token_latency` per evaluated token, where only the tokens past the prefix shared with the previous prompt are evaluated when `kv` is set.
+    """
     vocab: List[str]
     rvocab: Dict[str, int]
 
-    def __init__(self, **kwargs):
-        vocab = [ chr(c) for c in range(ord(' '), ord('~')) ] + [ '\n' ]
+    seed: Optional[int] = None
+    spread: float = 2.         # standard deviation of the seeded logits (larger is more peaked)
+    latency: float = 0.        # seconds per call
+    token_latency: float = 0.  # seconds per evaluated token
+    kv: bool = False           # simulate a KV cache holding the last evaluated prompt
+    kv_tokens: List[int] = []
+
+    calls: int = 0
+    evaluated: int = 0
+
+    def __init__(self, vocab_size:int=0, **kwargs):
+        symbols = [ chr(c) for c in range(ord(' '), ord('~')) ]
+        vocab = symbols + [ '\n' ]
+        # Additional tokens are strings of 2 or more printable characters (digits of their index in base len(symbols))
+        # The newline is excluded as it must stay a token on its own (it stops the completions)
+        base = len(symbols)
+        for i in range(len(vocab), vocab_size):
+            (n, token) = (i // base, symbols[i % base])
+            while n > 0:
+                (n, token) = (n // base, token + symbols[n % base])
+            vocab.append(token)
         rvocab = { c : i for (i,c) in  enumerate(vocab) }
         super().__init__(model=None, vocab=vocab, rvocab=rvocab, **kwargs)
 
-    def tokenize(self, text:str, whole:bool=True) -> List[int]:
+    def fingerprint(self) -> Optional[str]:
+        return None if self.seed is None else f"random:{self.seed}:{self.spread}:{len(self.vocab)}"
+
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
         return [ self.rvocab[c] for c in text ]
 
-    def detokenize(self, tokens:List[int], whole:bool=True) -> str:
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
         return ''.join([ self.vocab[i] for i in tokens ])
 
-    def impl_greedy(self, prompt: str):
-        probas = numpy.random.rand(len(self.vocab))
-        return numpy.log(probas / probas.sum())
+    def simulate(self, prompts: List[List[int]]):
+        """Sleep for the simulated compute time of one call evaluating `prompts` (in order)"""
+        evaluated = 0
+        for prompt in prompts:
+            if self.kv:
+                evaluated += len(prompt) - min(common_prefix(self.kv_tokens, prompt), len(prompt) - 1)
+                self.kv_tokens = list(prompt)
+            else:
+                evaluated += len(prompt)
+        self.calls += 1
+        self.evaluated += evaluated
+        delay = self.latency + self.token_latency * evaluated
+        if delay > 0:
+            time.sleep(delay)
+
+    def logprobs(self, prompt: List[int], out=None) -> numpy.ndarray:
+        digest = hashlib.sha256(numpy.asarray([ self.seed ] + list(prompt), dtype=numpy.int64).tobytes()).digest()
+        logits = numpy.random.default_rng(int.from_bytes(digest[:8], 'little')).standard_normal(len(self.vocab), dtype=numpy.single)
+        logits *= self.spread
+        return log_softmax(logits, out=logits if out is None else out)
+
+    def impl_greedy(self, prompt: Union[str,List[int]]):
+        if self.seed is None:
+            probas = numpy.random.rand(len(self.vocab)).astype(numpy.single)
+            probas /= probas.sum()
+            return numpy.log(probas, out=probas)
+        if isinstance(prompt, str):
+            prompt = self.tokenize(prompt)
+        self.simulate([ prompt ])
+        return self.logprobs(prompt)
+
+    def impl_greedy_batch(self, prompts: List[Union[str,List[int]]]):
+        if self.seed is None:
+            probas = numpy.random.rand(len(prompts), len(self.vocab)).astype(numpy.single)
+            probas /= probas.sum(axis=1, keepdims=True)
+            return numpy.log(probas, out=probas)
+        prompts = [ self.tokenize(prompt) if isinstance(prompt, str) else list(prompt) for prompt in prompts ]
+        # Lexicographic order places prompts with shared prefixes next to each other (as backends reusing their KV cache)
+        self.simulate(sorted(prompts))
+        results = numpy.empty((len(prompts), len(self.vocab)), dtype=numpy.single)
+        for (i,prompt) in enumerate(prompts):
+            self.logprobs(prompt, out=results[i])
+        return results
+
+    def impl_score_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[numpy.ndarray]) -> List[numpy.ndarray]:
+        return [ row[tokens_] for (row, tokens_) in zip(self.impl_greedy_batch(prompts), tokens) ]
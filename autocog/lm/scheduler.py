@@ -0,0 +1,116 @@
+
+from typing import Any, Dict, List, Tuple, Union, Optional, Callable
+from .lm import LM
+
+import asyncio
+import numpy
+
+class Scheduler(LM):
+    """
+    Wraps an LM to batch the `agreedy` (and `ascore_candidates`) calls of concurrent coroutines.
+    Calls are collected while a batch is being evaluated (or for `window` seconds when idle) then evaluated in one `agreedy_batch`.
+    """
+    window: float = 0.002 # seconds waiting for more calls before evaluating a batch when the LM is idle
+    size: int = 64        # maximum number of prompts in a batch
+    pending: List[Any] = []
+    running: int = 0
+    timer: Any = None
+
+    def __init__(self, lm:LM, **kwargs):
+        super().__init__(model=lm, **kwargs)
+
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
+        return self.model.tokenize(text, whole)
+
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
+        return self.model.detokenize(tokens, whole)
+
+    def fingerprint(self) -> Optional[str]:
+        return self.model.fingerprint()
+
+    def needs_prefill(self, key:str) -> bool:
+        return self.model.needs_prefill(key)
+
+    def prefill(self, tokens:List[int], key:str):
+        self.model.prefill(tokens, key)
+
+    async def aprefill(self, tokens:List[int], key:str):
+        await self.model.aprefill(tokens, key)
+
+    def greedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        return self.model.greedy(prompt)
+
+    def greedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        return self.model.greedy_batch(prompts)
+
+    def score_candidates(self, prompt: Union[str,List[int]], tokens: List[int]) -> numpy.ndarray:
+        return self.model.score_candidates(prompt, tokens)
+
+    def score_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[List[int]]) -> List[numpy.ndarray]:
+        return self.model.score_candidates_batch(prompts, tokens)
+
+    def greedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        return self.model.greedy_tail(prompt, count)
+
+    def score_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        return self.model.score_sequence(prompt, continuation)
+
+    def impl_greedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        return self.model.greedy(prompt)
+
+    async def agreedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((prompt, future))
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif self.running == 0 and self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    async def ascore_candidates(self, prompt: Union[str,List[int]], tokens: List[int]) -> numpy.ndarray:
+        return (await self.agreedy(prompt))[numpy.asarray(tokens, dtype=numpy.intp)]
+
+    async def agreedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        return numpy.stack(await asyncio.gather(*[ self.agreedy(prompt) for prompt in prompts ]))
+
+    async def ascore_candidates_batch(self, prompts: List[Union[str,List[int]]], tokens: List[List[int]]) -> List[numpy.ndarray]:
+        return list(await asyncio.gather(*[ self.ascore_candidates(prompt, tokens_) for (prompt, tokens_) in zip(prompts, tokens) ]))
+
+    async def agreedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        return await self.model.agreedy_tail(prompt, count)
+
+    async def ascore_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        return await self.model.ascore_sequence(prompt, continuation)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while len(self.pending) > 0:
+            (batch, self.pending) = (self.pending[:self.size], self.pending[self.size:])
+            self.running += 1
+            asyncio.ensure_future(self.dispatch(batch))
+
+    async def dispatch(self, batch: List[Tuple[Union[str,List[int]],asyncio.Future]]):
+        # Identical prompts (e.g. from the same few-shot preamble) are evaluated once
+        prompts = {}
+        for (prompt, future) in batch:
+            prompts.setdefault(prompt if isinstance(prompt, str) else tuple(prompt), prompt)
+        self.requests += 1
+        try:
+            logprobs = await self.model.agreedy_batch(list(prompts.values()))
+        except Exception as e:
+            for (prompt, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.running -= 1
+            # Calls received while this batch was evaluated form the next one
+            if self.running == 0 and len(self.pending) > 0:
+                self.flush()
+        rows = { key : row.copy() for (key, row) in zip(prompts.keys(), logprobs) }
+        for (prompt, future) in batch:
+            if not future.done():
+                future.set_result(rows[prompt if isinstance(prompt, str) else tuple(prompt)])
@@ -0,0 +1,85 @@
+
+from typing import Any, Dict, List, Tuple, Union, Optional, Callable
+
+import os
+import atexit
+import sqlite3
+import hashlib
+
+import numpy
+
+def fingerprint_file(path:str, chunk:int=2**20) -> str:
+    """Hash of the size, the first and the last `chunk` bytes of a file (model files are too large to be fully hashed)"""
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode())
+    with open(path, 'rb') as F:
+        digest.update(F.read(chunk))
+        if size > chunk:
+            F.seek(max(chunk, size - chunk))
+            digest.update(F.read(chunk))
+    return digest.hexdigest()
+
+def topk(logprobs, k:int):
+    """Indices and values of the `k` largest logprobs (in decreasing order)"""
+    logprobs = numpy.asarray(logprobs)
+    if k < len(logprobs):
+        ids = numpy.argpartition(logprobs, -k)[-k:]
+    else:
+        ids = numpy.arange(len(logprobs))
+    ids = ids[numpy.argsort(-logprobs[ids])]
+    return (ids.astype(numpy.int32), logprobs[ids])
+
+def expand(ids, logprobs, size:int):
+    """Full logprobs row from its top-k: the remaining probability mass is spread uniformly over the other tokens"""
+    result = numpy.empty(size, dtype=numpy.single)
+    if len(ids) < size:
+        rest = max(1. - float(numpy.exp(logprobs.astype(numpy.double)).sum()), numpy.finfo(numpy.single).tiny)
+        result.fill(numpy.log(rest / (size - len(ids))))
+    result[ids] = logprobs
+    return result
+
+class LogprobStore:
+    """SQLite file memoizing the top-k logprobs returned by `LM.greedy` for a given model and sequence of tokens"""
+    def __init__(self, path:str, topk:int=64, flush:int=256):
+        self.topk = topk
+        self.flush = flush
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS logprobs (model TEXT, tokens BLOB, size INTEGER, ids BLOB, logprobs BLOB, PRIMARY KEY (model, tokens))')
+        atexit.register(self.commit)
+
+    @staticmethod
+    def key(tokens:List[int]) -> bytes:
+        return numpy.asarray(tokens, dtype=numpy.int32).tobytes()
+
+    def get(self, model:str, tokens:List[int]):
+        row = self.connection.execute('SELECT size, ids, logprobs FROM logprobs WHERE model=? AND tokens=?', (model, self.key(tokens))).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        (size, ids, logprobs) = row
+        return expand(numpy.frombuffer(ids, dtype=numpy.int32), numpy.frombuffer(logprobs, dtype=numpy.single), size)
+
+    def put(self, model:str, tokens:List[int], logprobs) -> numpy.ndarray:
+        """Returns the row as `get` will serve it (so a run reading the store reproduces the run that wrote it)"""
+        (ids, values) = topk(logprobs, self.topk)
+        values = values.astype(numpy.single)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO logprobs VALUES (?, ?, ?, ?, ?)',
+            (model, self.key(tokens), len(logprobs), ids.tobytes(), values.tobytes())
+        )
+        self.pending += 1
+        if self.pending >= self.flush:
+            self.commit()
+        return expand(ids, values, len(logprobs))
+
+    def commit(self):
+        if self.pending > 0:
+            self.connection.commit()
+            self.pending = 0
@@ -0,0 +1,164 @@
+
+from typing import Any, Dict, List, Tuple, Union, Optional, Callable
+from .lm import LM, common_prefix
+from .store import topk, expand
+
+import atexit
+import struct
+import threading
+import numpy
+
+MAGIC = b'ACTRACE1'
+
+# Record kinds
+TOKENIZE   = b'T'
+DETOKENIZE = b'D'
+GREEDY     = b'G'
+
+def write_str(F, text:Optional[str]):
+    data = b'' if text is None else text.encode('utf-8')
+    F.write(struct.pack('<I', len(data)))
+    F.write(data)
+
+def read_str(F) -> str:
+    (size,) = struct.unpack('<I', F.read(4))
+    return F.read(size).decode('utf-8')
+
+def write_array(F, array:numpy.ndarray):
+    F.write(struct.pack('<I', len(array)))
+    F.write(array.tobytes())
+
+def read_array(F, dtype) -> numpy.ndarray:
+    (size,) = struct.unpack('<I', F.read(4))
+    return numpy.frombuffer(F.read(size * numpy.dtype(dtype).itemsize), dtype=dtype)
+
+def prompt_key(prompt: Union[str,List[int]]) -> Union[str,Tuple[int,...]]:
+    return prompt if isinstance(prompt, str) else tuple(int(t) for t in prompt)
+
+class Recorder(LM):
+    """
+    Wraps an LM to write its answers to `tokenize`, `detokenize`, and `greedy` in a binary trace (served back by `Replay`).
+    Logprobs are stored as the top-k float16 values and the LM returns the same approximation so a replay is bit-exact with the recorded run.
+    """
+    path: str
+    topk: int = 64
+    file: Any = None
+    lock: Any = None
+    last: List[int] = [] # prompts are written as the length of the prefix shared with the previous one and the remaining tokens
+
+    def __init__(self, lm:LM, path:str, **kwargs):
+        super().__init__(model=lm, path=path, lock=threading.Lock(), **kwargs)
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        write_str(self.file, lm.fingerprint() or '')
+        atexit.register(self.close)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def fingerprint(self) -> Optional[str]:
+        return self.model.fingerprint()
+
+    def needs_prefill(self, key:str) -> bool:
+        return self.model.needs_prefill(key)
+
+    def prefill(self, tokens:List[int], key:str):
+        self.model.prefill(tokens, key)
+
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
+        tokens = self.model.tokenize(text, whole)
+        with self.lock:
+            self.file.write(TOKENIZE + struct.pack('<?', whole))
+            write_str(self.file, text)
+            write_array(self.file, numpy.asarray(tokens, dtype=numpy.int32))
+        return tokens
+
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
+        text = self.model.detokenize(tokens, whole)
+        with self.lock:
+            self.file.write(DETOKENIZE + struct.pack('<?', whole))
+            write_array(self.file, numpy.asarray(tokens, dtype=numpy.int32))
+            write_str(self.file, text)
+        return text
+
+    def write(self, prompt: Union[str,List[int]], logprobs: numpy.ndarray) -> numpy.ndarray:
+        (ids, values) = topk(logprobs, self.topk)
+        values = values.astype(numpy.half)
+        with self.lock:
+            self.file.write(GREEDY + struct.pack('<?', isinstance(prompt, str)))
+            if isinstance(prompt, str):
+                write_str(self.file, prompt)
+            else:
+                prefix = common_prefix(self.last, prompt)
+                self.file.write(struct.pack('<I', prefix))
+                write_array(self.file, numpy.asarray(prompt[prefix:], dtype=numpy.int32))
+                self.last = list(prompt)
+            self.file.write(struct.pack('<I', len(logprobs)))
+            write_array(self.file, ids)
+            write_array(self.file, values)
+        return expand(ids, values.astype(numpy.single), len(logprobs))
+
+    def impl_greedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        return self.write(prompt, self.model.greedy(prompt))
+
+    def impl_greedy_batch(self, prompts: List[Union[str,List[int]]]) -> numpy.ndarray:
+        logprobs = self.model.greedy_batch(prompts)
+        return numpy.stack([ self.write(prompt, row) for (prompt, row) in zip(prompts, logprobs) ])
+
+class Replay(LM):
+    """Serves the answers recorded in a trace by `Recorder` (calls that were not recorded raise an exception)"""
+    digest: Optional[str] = None
+    tokens: Dict[Tuple[str,bool],List[int]] = {}
+    texts: Dict[Tuple[Tuple[int,...],bool],str] = {}
+    logprobs: Dict[Any,Any] = {} # prompt -> (vocabulary size, top-k ids, top-k logprobs)
+
+    def __init__(self, path:str, retries:int=1, **kwargs):
+        (tokens, texts, logprobs, last) = ({}, {}, {}, ())
+        with open(path, 'rb') as F:
+            if F.read(len(MAGIC)) != MAGIC:
+                raise Exception(f"Not an LM trace: {path}")
+            digest = read_str(F) or None
+            while True:
+                kind = F.read(1)
+                if len(kind) == 0:
+                    break
+                (flag,) = struct.unpack('<?', F.read(1))
+                if kind == TOKENIZE:
+                    text = read_str(F)
+                    tokens.update({ (text, flag) : read_array(F, numpy.int32).tolist() })
+                elif kind == DETOKENIZE:
+                    key = tuple(read_array(F, numpy.int32).tolist())
+                    texts.update({ (key, flag) : read_str(F) })
+                elif kind == GREEDY:
+                    if flag:
+                        prompt = read_str(F)
+                    else:
+                        (prefix,) = struct.unpack('<I', F.read(4))
+                        prompt = last = last[:prefix] + tuple(read_array(F, numpy.int32).tolist())
+                    (size,) = struct.unpack('<I', F.read(4))
+                    ids = read_array(F, numpy.int32)
+                    logprobs.update({ prompt : (size, ids, read_array(F, numpy.half).astype(numpy.single)) })
+                else:
+                    raise Exception(f"Corrupted LM trace: {path}")
+        super().__init__(model=None, digest=digest, tokens=tokens, texts=texts, logprobs=logprobs, retries=retries, **kwargs)
+
+    def fingerprint(self) -> Optional[str]:
+        return self.digest
+
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
+        if not (text, whole) in self.tokens:
+            raise Exception(f"Not in trace: tokenize({text!r}, whole={whole})")
+        return list(self.tokens[(text, whole)])
+
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
+        key = (prompt_key(tokens), whole)
+        if not key in self.texts:
+            raise Exception(f"Not in trace: detokenize({list(tokens)}, whole={whole})")
+        return self.texts[key]
+
+    def impl_greedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        key = prompt_key(prompt)
+        if not key in self.logprobs:
+            raise Exception(f"Not in trace: greedy({prompt if isinstance(prompt, str) else list(prompt)})")
+        return expand(*self.logprobs[key][1:], self.logprobs[key][0])
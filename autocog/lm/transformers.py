@@ -1,17 +1,59 @@
 
 from typing import Any, Dict, List, Tuple, Union, Optional, Callable, NamedTuple
-from .lm import LM
+from .lm import LM, common_prefix, log_softmax, logsumexp
+from .store import fingerprint_file
+
+import os
+import glob
+import copy
+import numpy
+import hashlib
 
 try:
+    import torch
     import transformers
     from transformers import AutoTokenizer, AutoModelForCausalLM
 except:
     transformers = "Package `transformers` needed for (Huggingface's) transformers wrapper"
     print(f"Warning: {transformers}")
 
+def crop(past:Any, length:int) -> Any:
+    """Keep the first `length` positions of a KV cache (`transformers.Cache` or legacy tuples)"""
+    if hasattr(past, 'crop'):
+        past.crop(length)
+        return past
+    return tuple([ tuple([ t[:, :, :length] for t in layer ]) for layer in past ])
+
+def expand(past:Any, size:int) -> Any:
+    """Copy of a KV cache (of a single sequence) repeated to a batch of `size` sequences"""
+    if hasattr(past, 'batch_repeat_interleave'):
+        past = copy.deepcopy(past)
+        past.batch_repeat_interleave(size)
+        return past
+    return tuple([ tuple([ t.expand(size, *t.shape[1:]) for t in layer ]) for layer in past ])
+
+def fingerprint_weights(model_path:str, model:Any) -> Optional[str]:
+    """Hash of the weight files of a local checkpoint or commit of a model from the hub (`None` when neither is known)"""
+    if os.path.isdir(model_path):
+        files = sorted([ f for ext in ('safetensors', 'bin', 'pt') for f in glob.glob(os.path.join(model_path, f'*.{ext}')) ])
+        digests = [ os.path.basename(f) + ':' + fingerprint_file(f) for f in files ]
+    else:
+        commit = getattr(model.config, '_commit_hash', None)
+        digests = [] if commit is None else [ commit ]
+    if len(digests) == 0:
+        return None
+    return hashlib.sha256('\n'.join(digests).encode()).hexdigest()
+
 class TfLM(LM):
     tokenizer: Any
-    device: str
+    device: Optional[str]
+    digest: Optional[str]
+
+    past: Any = None               # KV cache of the current path
+    past_tokens: List[int] = []    # tokens in `past`
+    past_logits: Any = None        # logits following the last token in `past`
+
+    batch_size: int = 16           # maximum number of sequences in one forward pass of `greedy_batch`
 
     def __init__(self,model_path:str, device:Optional[str], T=None, M=None, **kwargs):
         if isinstance(transformers,str):
@@ -27,18 +69,105 @@ class TfLM(LM):
         if device is not None:
             model = model.to(device)
 
-        super().__init__(model=model, tokenizer=tokenizer, device=device, **kwargs)
+        # The configuration does not identify the weights (checkpoints of the same architecture, models updated in place)
+        weights = fingerprint_weights(model_path, model)
+        digest = None if weights is None else f"{model_path}:{weights}"
+        super().__init__(model=model, tokenizer=tokenizer, device=device, digest=digest, **kwargs)
+
+    def fingerprint(self) -> Optional[str]:
+        return self.digest
 
-    def tokenize(self, text:str, whole:bool=True) -> List[int]:
-        return self.tokenizer.encode(text, add_special_tokens=True)
+    def impl_tokenize(self, text:str, whole:bool=True) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=whole)
 
-    def detokenize(self, tokens:List[int], whole:bool=True) -> str:
+    def impl_detokenize(self, tokens:List[int], whole:bool=True) -> str:
         return self.tokenizer.decode(tokens)
 
-    def impl_greedy(self, prompt: str) -> List[float]:
-        input_ids = self.tokenizer.encode(prompt, add_special_tokens=True, return_tensors='pt')
+    def rollback(self, tokens:List[int]):
+        """Crop the KV cache of the current path to the longest prefix shared with `tokens`"""
+        prefix = common_prefix(self.past_tokens, tokens)
+        if prefix == len(self.past_tokens):
+            return
+        if prefix == 0:
+            self.past = None
+        else:
+            self.past = crop(self.past, prefix)
+        self.past_tokens = self.past_tokens[:prefix]
+        self.past_logits = None
+
+    def evaluate(self, prompt: Union[str,List[int]], count:int=1) -> numpy.ndarray:
+        """Logits following each of the last `count` tokens of `prompt` (extending the current path)"""
+        if isinstance(prompt, str):
+            prompt = self.tokenizer.encode(prompt, add_special_tokens=True)
+        if len(prompt) == 0:
+            raise Exception("Cannot evaluate an empty prompt")
+
+        self.rollback(prompt)
+        if count == 1 and len(self.past_tokens) == len(prompt) and self.past_logits is not None:
+            return self.past_logits[None]
+        if len(self.past_tokens) > len(prompt) - count:
+            # Only the logits of the last token are kept so the last `count` tokens are evaluated again
+            self.rollback(prompt[:len(prompt)-count])
+
+        input_ids = torch.tensor([ prompt[len(self.past_tokens):] ], dtype=torch.long)
         if self.device is not None:
             input_ids = input_ids.to(self.device)
-        logits = self.model(input_ids=input_ids).logits
-        logits = logits[0,0].tolist()
+        with torch.no_grad():
+            output = self.model(input_ids=input_ids, past_key_values=self.past, use_cache=True)
+
+        self.past = output.past_key_values
+        self.past_tokens = list(prompt)
+        logits = output.logits[0,-count:].float().cpu().numpy()
+        self.past_logits = logits[-1]
         return logits
+
+    def impl_greedy(self, prompt: Union[str,List[int]]) -> numpy.ndarray:
+        return log_softmax(self.evaluate(prompt)[0])
+
+    def impl_score_candidates(self, prompt: Union[str,List[int]], tokens: numpy.ndarray) -> numpy.ndarray:
+        logits = self.evaluate(prompt)[0]
+        return logits[tokens] - logsumexp(logits)
+
+    def impl_greedy_tail(self, prompt: List[int], count:int) -> numpy.ndarray:
+        return log_softmax(self.evaluate(prompt, count))
+
+    def impl_score_sequence(self, prompt: List[int], continuation: List[int]) -> numpy.ndarray:
+        logits = self.evaluate(list(prompt) + list(continuation[:-1]), len(continuation))
+        return logits[numpy.arange(len(continuation)), continuation] - logsumexp(logits)
+
+    def impl_greedy_batch(self, prompts: List[Union[str,List[int]]]):
+        prompts = [ self.tokenizer.encode(prompt, add_special_tokens=True) if isinstance(prompt, str) else list(prompt) for prompt in prompts ]
+        pad = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+        # The prefix shared by all prompts is evaluated once (on the current path) then broadcast to the batch
+        shared = min([ common_prefix(prompts[0], prompt) for prompt in prompts[1:] ] + [ min(map(len, prompts)) - 1 ])
+        if shared > 0:
+            self.rollback(prompts[0][:shared])
+            if len(self.past_tokens) < shared:
+                self.impl_greedy(prompts[0][:shared])
+
+        # Sorting by length limits the padding in each chunk
+        order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+        results = [ None ] * len(prompts)
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start:start+self.batch_size]
+            lengths = [ len(prompts[i]) - shared for i in chunk ]
+
+            # Right padding: the causal mask prevents real tokens from attending to the padding
+            input_ids = torch.full((len(chunk), max(lengths)), pad, dtype=torch.long)
+            attention_mask = torch.ones((len(chunk), shared + max(lengths)), dtype=torch.long)
+            for (b,i) in enumerate(chunk):
+                input_ids[b,:lengths[b]] = torch.tensor(prompts[i][shared:], dtype=torch.long)
+                attention_mask[b,shared+lengths[b]:] = 0
+            if self.device is not None:
+                input_ids = input_ids.to(self.device)
+                attention_mask = attention_mask.to(self.device)
+
+            past = None if shared == 0 else expand(self.past, len(chunk))
+            with torch.inference_mode():
+                logits = self.model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past, use_cache=past is not None).logits
+                logits = logits[torch.arange(len(chunk)), torch.tensor(lengths) - 1]
+                logprobs = torch.log_softmax(logits.float(), dim=-1).cpu().numpy()
+            for (b,i) in enumerate(chunk):
+                results[i] = logprobs[b]
+        return numpy.stack(results)
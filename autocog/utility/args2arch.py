@@ -8,8 +8,9 @@ from ..config import version
 
 from ..arch.architecture import CognitiveArchitecture as CogArch
 from ..arch.orchestrator import Serial, Async
+from ..fta.automaton import SearchOptions
 
-from .models import loader as model_loader
+from .models import loader as model_loader, models as model_registry, router_loader
 
 from ..sta.syntax import Syntax, syntax_kwargs as SyntaxKwargs
 
@@ -20,8 +21,21 @@ def argparser():
     parser.add_argument('--orch',     help="""Type of orchestrator: `serial` or `async`.""", default='serial')
 
     parser.add_argument('--model',    help="""Load a model from a GGUF file using llama.cpp (and llama-cpp-python)""", default=None)
+    parser.add_argument('--synthetic', help="""JSON options of the synthetic LM used without --model: {"seed":0,"vocab_size":32000,"latency":0.01,"token_latency":0.0001,"kv":true}""", default=None)
+    parser.add_argument('--record',   help="""Binary trace where the answers of the LM are recorded (top-k float16 logprobs)""", default=None)
+    parser.add_argument('--replay',   help="""Binary trace (from --record) used instead of a model""", default=None)
     parser.add_argument('--ctx',      help="""Context size for GGUF models""", default=4096)
+    parser.add_argument('--workers',  help="""Number of processes each loading the GGUF model, concurrent jobs are dispatched to them""", default=1)
+    parser.add_argument('--batch',    help="""Window (in ms) during which the LM calls of concurrent jobs are collected to be evaluated as one batch (use with --orch async). Disabled when 0.""", default=0)
+    parser.add_argument('--ram',      help="""Memory budget (in MB) for the weights of the loaded models, the least recently used ones are unloaded when exceeded. Unlimited when 0.""", default=0)
+    parser.add_argument('--route',    help="""JSON routing some actions to other GGUF models: {"routes":[{"model":path,"kinds":["Choose"],"cogs":[...],"prompts":[...]}],"escalate":path,"threshold":0.5}. Models must share the tokenizer of --model.""", default=None)
+    parser.add_argument('--draft',    help="""GGUF model proposing the tokens of completions, verified by the main model (must share its tokenizer)""", default=None)
+    parser.add_argument('--cache',    help="""Memory budget (in MB) of the prompt cache shared by all jobs (logprobs and KV states). Disabled when 0.""", default=0)
+    parser.add_argument('--states',   help="""Directory where the KV states following the header of each prompt are persisted (keyed by model, syntax, cog, and prompt)""", default=None)
+    parser.add_argument('--store',    help="""SQLite file where the top-k logprobs of each prompt are persisted across runs (keyed by model fingerprint and tokens).""", default=None)
+    parser.add_argument('--topk',     help="""Number of logprobs kept per prompt in the store""", default=64)
     parser.add_argument('--syntax',   help=f"""One of `{'`, `'.join(SyntaxKwargs.keys())}` or a dictionary of the kwargs to initialize a Syntax object (inlined JSON or path to a file). If used more than once, only the first can be string, the next ones must be dictionaries, and later values override the earlier ones.""", action='append', default=[])
+    parser.add_argument('--search',   help="""Options of the search through the Finite Thought Automata as a dictionary (inlined JSON or path to a file). For example, `{ "choose" : "sequence" }` scores each choice in one LM call.""", default=None)
     parser.add_argument('--cogs',     help="""Files to load as cog in the architecture, prefix with its identifier else the filename is used. For example, `some/cognitive/mcq.sta` and `my.tool:some/python/tool.py` will load a Structured Thought Automaton as `mcq` and a Python file as `my.tool`. Alternatively, JSON (inline or path) can be used to provide kwargs for CogArch.load (each JSON can be either single dict of list of dict).""", action='append', default=[])
 
     parser.add_argument('--command',  help="""Command to be executed by the architecture as a dictionary. `__tag` identify the cog while `__entry` identify the entry point in this cog (defaults to `main`). All other field will be forwarded as keyworded args. Example: `{ "__tag" : "writer", "__entry" : "main", **kwarg }` (inlined JSON or path to a file). Any command argument can be a list of dictionary.""", action='append')
@@ -65,14 +79,35 @@ def parseargs(argv):
         for s in args.syntax[1:]:
             syntax_kwargs.update(parse_json(s))
     
+    if float(args.ram) > 0:
+        model_registry.budget = int(float(args.ram) * 2**20)
+
     (lm,syntax) = model_loader(
         models_path=args.model,
         syntax=syntax,
         n_ctx=int(args.ctx),
+        cache_size=float(args.cache),
+        store_path=args.store,
+        store_topk=int(args.topk),
+        workers=int(args.workers),
+        synthetic={} if args.synthetic is None else parse_json(args.synthetic),
+        record=args.record,
+        replay=args.replay,
+        states=args.states,
         **syntax_kwargs
     )
 
-    arch = CogArch(Orch=Orch, lm=lm, syntax=syntax, libdir=args.libdir)
+    if float(args.batch) > 0:
+        from ..lm.scheduler import Scheduler
+        lm = Scheduler(lm, window=float(args.batch) / 1000.)
+
+    search = SearchOptions(**parse_json(args.search)) if args.search is not None else SearchOptions()
+    if args.draft is not None:
+        search.draft = model_registry.get(args.draft, n_ctx=int(args.ctx))
+
+    router = router_loader(n_ctx=int(args.ctx), **parse_json(args.route)) if args.route is not None else None
+
+    arch = CogArch(Orch=Orch, lm=lm, syntax=syntax, libdir=args.libdir, search=search, router=router)
 
     for cog in args.cogs:
         try:
@@ -1,16 +1,107 @@
 
+from typing import Any, Dict, List, Tuple, Union, Optional
+
 from ..sta.syntax import Syntax, syntax_kwargs as SyntaxKwargs
-from ..lm import RLM
-from ..lm import Llama
+from ..lm import backend
+from ..lm.cache import PromptCache
+from ..fta.automaton import Route, Router
 
-def loader(models_path=None, syntax=None, n_ctx=4096, **syntax_kwargs):
-    if models_path is None or models_path == '':
-        models_path = ''
-        lm = RLM()
-    elif models_path.endswith('.gguf'):
-        lm = Llama(model_path=models_path, n_ctx=n_ctx)
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import os
+
+class ModelRegistry:
+    """
+    Models shared by all the architectures of a process. Each model is created once (per path and context size) and its weights are loaded on first use.
+    When loading a model would exceed `budget` (bytes, estimated from file sizes), the least recently used models are unloaded (and reloaded when used again).
+    Models are pinned while a call is in flight (from any thread) and are never unloaded while pinned, the budget can then be exceeded.
+    """
+    def __init__(self, budget:Optional[int]=None):
+        self.budget = budget
+        self.models = {}
+        self.loaded = OrderedDict()
+        self.pins = {} # id(lm) -> number of calls in flight
+        self.lock = threading.RLock()
+
+    def get(self, path:str, n_ctx:int=4096, **kwargs):
+        """The kwargs (cache, store, ...) are only used when the model is first requested"""
+        key = (os.path.realpath(path), n_ctx)
+        if not key in self.models:
+            if path.endswith('.gguf'):
+                lm = backend('llama')(model_path=path, n_ctx=n_ctx, lazy=True, registry=self, **kwargs)
+            else:
+                raise Exception(f'Unrecognized model file extension: {path.split(".")[-1]}')
+            self.models.update({ key : lm })
+        return self.models[key]
+
+    @staticmethod
+    def size(lm) -> int:
+        return os.path.getsize(lm.model_path)
+
+    @property
+    def usage(self) -> int:
+        return sum([ self.size(lm) for lm in self.loaded.values() ])
+
+    def touch(self, lm):
+        with self.lock:
+            self.loaded.update({ id(lm) : lm })
+            self.loaded.move_to_end(id(lm))
+
+    @contextmanager
+    def pin(self, lm):
+        with self.lock:
+            self.pins.update({ id(lm) : self.pins.get(id(lm), 0) + 1 })
+        try:
+            yield lm
+        finally:
+            with self.lock:
+                self.pins[id(lm)] -= 1
+                if self.pins[id(lm)] == 0:
+                    del self.pins[id(lm)]
+
+    def reserve(self, lm):
+        """Unload the least recently used (and not pinned) models until `lm` fits in the budget"""
+        if self.budget is None:
+            return
+        with self.lock:
+            usage = self.size(lm) + sum([ self.size(m) for m in self.loaded.values() if m is not lm ])
+            for m in list(self.loaded.values()):
+                if usage <= self.budget:
+                    break
+                if m is not lm and not id(m) in self.pins:
+                    usage -= self.size(m)
+                    self.unload(m)
+
+    def unload(self, lm):
+        with self.lock:
+            lm.unload()
+            del self.loaded[id(lm)]
+
+models = ModelRegistry()
+
+def loader(models_path=None, syntax=None, n_ctx=4096, cache_size=0, store_path=None, store_topk=64, registry=None, workers=1, synthetic={}, record=None, replay=None, states=None, **syntax_kwargs):
+    cache = PromptCache(budget=int(cache_size * 2**20)) if cache_size > 0 else None
+    store = None
+    if store_path is not None:
+        from ..lm.store import LogprobStore
+        store = LogprobStore(path=store_path, topk=store_topk)
+
+    if replay is not None:
+        lm = backend('replay')(path=replay, cache=cache, store=store)
+    elif models_path is None or models_path == '':
+        lm = backend('random')(cache=cache, store=store, **synthetic)
+    elif workers > 1:
+        lm = backend('pool')(backend='llama', model_kwargs={ 'model_path' : models_path, 'n_ctx' : n_ctx, 'states' : states }, size=workers, cache=cache, store=store)
     else:
-        raise Exception(f'Unrecognized model file extension: {models_path.split(".")[-1]}')
+        lm = (models if registry is None else registry).get(models_path, n_ctx=n_ctx, cache=cache, store=store, states=states)
+
+    if record is not None:
+        from ..lm.trace import Recorder
+        lm = Recorder(lm, path=record)
+
+    if models_path is None:
+        models_path = ''
 
     if syntax is None and len(models_path) > 0:
         # TODO does llama.cpp (or GUFF) contains that info?
@@ -34,4 +125,13 @@ def loader(models_path=None, syntax=None, n_ctx=4096, **syntax_kwargs):
 
     syntax = Syntax(**syntax)
 
-    return (lm,syntax)
\ No newline at end of file
+    return (lm,syntax)
+
+def router_loader(routes=[], escalate=None, threshold=0., n_ctx=4096, registry=None) -> Router:
+    """Routes given as `{ "model" : path, "kinds" : [...], "cogs" : [...], "prompts" : [...] }`, models are shared through the registry"""
+    registry = models if registry is None else registry
+    return Router(
+        routes=[ Route(lm=registry.get(route['model'], n_ctx=n_ctx), **{ k : v for (k,v) in route.items() if k != 'model' }) for route in routes ],
+        escalate=None if escalate is None else registry.get(escalate, n_ctx=n_ctx),
+        threshold=threshold
+    )
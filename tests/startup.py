@@ -0,0 +1,29 @@
+
+import sys
+import statistics
+import subprocess
+
+# Startup with the random LM: must not import heavy backends
+script = """
+import sys, time
+start = time.perf_counter()
+import autocog
+from autocog.utility.models import loader
+loader()
+print(time.perf_counter() - start)
+print('imported:' + ','.join([ m for m in ('torch', 'transformers', 'llama_cpp') if m in sys.modules ]))
+"""
+
+threshold = float(sys.argv[1]) if len(sys.argv) > 1 else 3.
+repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+timings = []
+for r in range(repeats):
+    output = subprocess.run([ sys.executable, '-c', script ], check=True, capture_output=True, text=True).stdout.strip().split('\n')
+    timings.append(float(output[-2]))
+    imported = output[-1][len('imported:'):]
+    assert imported == '', f"Backends imported at startup: {imported}"
+
+median = statistics.median(timings)
+print(f"startup: median={median:.3f}s min={min(timings):.3f}s max={max(timings):.3f}s")
+assert median < threshold, f"Startup takes {median:.3f}s (threshold: {threshold}s)"